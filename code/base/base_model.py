@@ -1,5 +1,7 @@
 import tensorflow as tf
 from utils.loss import f1_loss, binary_focal_loss
+from data_loader.tf_data import TFDataPipeline, TFRecordPipeline
+from utils.metrics import F1_THRESHOLDS
 
 
 class BaseModel:
@@ -37,8 +39,9 @@ class BaseModel:
         else:
             latest_checkpoint = self.config.checkpoint_dir \
                 + '-{}'.format(checkpoint_nb)
-            self.saver = tf.train.import_meta_graph(
-                "{}.meta".format(latest_checkpoint))
+            # variables are restored by name into the graph built by the
+            # model, so checkpoints saved with the former float32 input
+            # placeholder load as well
             self.saver.restore(sess, latest_checkpoint)
             print("Model loaded")
 
@@ -72,17 +75,46 @@ class BaseModel:
         except AttributeError:
             print('WARN: input_size not set - using 512')
             self.config.input_size = 512
+        if not hasattr(self.config, 'input_scale'):
+            # 1.0 keeps the 0-255 range the models were trained with
+            self.config.input_scale = 1.0
         self.is_training = tf.placeholder(tf.bool)
         self.class_weights = tf.placeholder(
             tf.float32, shape=[1, 28], name="weights")
         self.class_weights = tf.stop_gradient(
             self.class_weights, name="stop_gradient")
-        self.input = tf.placeholder(
-            tf.float32, shape=[None, 4, 512, 512], name="input")
-        self.label = tf.placeholder(tf.float32, shape=[None, 28])
+        if not hasattr(self.config, 'input_pipeline'):
+            self.config.input_pipeline = 'feed_dict'
+        if self.config.input_pipeline in ['tf_data', 'tfrecord']:
+            # images and labels come from a tf.data iterator
+            # (they can still be fed through feed_dict)
+            if self.config.input_pipeline == 'tf_data':
+                self.pipeline = TFDataPipeline(self.config)
+            else:
+                self.pipeline = TFRecordPipeline(self.config)
+            self.input, self.label = self.pipeline.get_next()
+        else:
+            self.pipeline = None
+            # side of the images served by the loader
+            # (smaller than 512 with a resized cache)
+            if not hasattr(self.config, 'image_size'):
+                self.config.image_size = 512
+            size = self.config.image_size
+            self.input = tf.placeholder(
+                tf.uint8, shape=[None, 4, size, size], name="input")
+            self.label = tf.placeholder(tf.float32, shape=[None, 28])
+        # The images are fed as uint8 (4x smaller than float32 in host
+        # memory and transfers) and cast and scaled in the graph
         x = tf.transpose(self.input, perm=[0, 2, 3, 1])
-        self.input_layer = tf.image.resize_images(
-            x, (self.config.input_size, self.config.input_size))
+        x = tf.cast(x, tf.float32)
+        if self.config.input_scale != 1.0:
+            x = x * self.config.input_scale
+        if x.shape[1:3].as_list() == [self.config.input_size] * 2:
+            # already at the right size (resized cache or pipeline)
+            self.input_layer = x
+        else:
+            self.input_layer = tf.image.resize_images(
+                x, (self.config.input_size, self.config.input_size))
 
     def build_loss_output(self):
         losses_names = ["use_weighted_loss", "f1_loss", "focal_loss"]
@@ -102,23 +134,97 @@ class BaseModel:
         with tf.name_scope("output"):
             self.out = tf.nn.sigmoid(self.logits, name='out')
         with tf.name_scope("loss"):
+            # Weight of every example of the batch (e.g. its multiplicity
+            # in a bootstrap sample), 1 if not fed
+            self.example_weights = tf.placeholder_with_default(
+                tf.ones_like(self.label[:, 0]), shape=[None],
+                name="example_weights")
+            weights = tf.expand_dims(self.example_weights, 1)
+            # weighted mean over the examples and classes
+            n_weighted = tf.maximum(
+                tf.reduce_sum(self.example_weights), 1e-8) * 28
             if losses["f1_loss"]:
-                self.loss = f1_loss(y_true=self.label, y_pred=self.out)
+                self.loss = f1_loss(y_true=self.label, y_pred=self.out,
+                                    weights=weights)
             elif losses["use_weighted_loss"]:
-                self.loss = tf.losses.compute_weighted_loss(
+                self.loss = tf.reduce_sum(
                     tf.nn.sigmoid_cross_entropy_with_logits(
-                        labels=self.label, logits=self.logits),
-                    weights=self.class_weights)
+                        labels=self.label, logits=self.logits)
+                    * self.class_weights * weights) / n_weighted
             elif losses["focal_loss"]:
                 self.loss = binary_focal_loss(y_true=self.label,
-                                              y_pred=self.out)
+                                              y_pred=self.out,
+                                              weights=weights)
             else:
-                self.loss = tf.reduce_mean(
+                self.loss = tf.reduce_sum(
                     tf.nn.sigmoid_cross_entropy_with_logits(
-                        labels=self.label, logits=self.logits))
+                        labels=self.label, logits=self.logits)
+                    * weights) / n_weighted
 
             update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
             with tf.control_dependencies(update_ops):
                 self.train_step = tf.train.AdamOptimizer(
                     self.config.learning_rate).minimize(
                         self.loss, global_step=self.global_step_tensor)
+
+        if not hasattr(self.config, 'in_graph_metrics'):
+            self.config.in_graph_metrics = False
+        if self.config.in_graph_metrics:
+            self.build_metrics()
+
+    def build_metrics(self):
+        """
+        Streaming validation metrics: the per class TP/FP/FN counts of the
+        decision rule of get_pred_from_probas and of probas > threshold
+        (F1_THRESHOLDS) are accumulated in local variables, with the sum
+        of the batch losses, so that only the final counts are fetched.
+
+        self.reset_metrics resets the variables, self.update_metrics adds
+        the batch fed, self.metric_counts are the [3, 1 + T, 28] counts
+        (tp, fp, fn) and self.metric_loss the (loss sum, number of batches).
+        """
+        def local_variable(name, shape, dtype):
+            return tf.Variable(
+                tf.zeros(shape, dtype=dtype), trainable=False, name=name,
+                collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+        with tf.name_scope("metrics"):
+            # compared in float64, as the former numpy metrics
+            probas = tf.cast(self.out, tf.float64)
+            labels = self.label > 0.5
+            # the rule of get_pred_from_probas (see decision_rule), with
+            # its tie order: the mask is built from the ranks of top_k (the
+            # lowest classes first among equal probas), not by comparing
+            # to the m-th proba, so that ties do not predict more classes
+            above = probas > 0.5
+            count = tf.reduce_sum(tf.cast(above, tf.int32), axis=1)
+            # without probas > 0.5, the first most probable class (argmax)
+            first = tf.cast(tf.one_hot(
+                tf.nn.top_k(probas, k=1).indices[:, 0], 28), tf.bool)
+            # above 4, the 4 most probable ones, the highest classes first
+            # among equal probas: top_k of the reversed classes
+            last = 27 - tf.nn.top_k(tf.reverse(probas, [1]), k=4).indices
+            capped = tf.reduce_any(
+                tf.cast(tf.one_hot(last, 28), tf.bool), axis=1)
+            rule = tf.where(tf.equal(count, 0), first,
+                            tf.where(count > 4, capped, above))
+            thresholds = tf.constant(F1_THRESHOLDS, dtype=tf.float64)
+            preds = tf.concat(
+                [tf.expand_dims(rule, 0),
+                 tf.expand_dims(probas, 0) >
+                 tf.reshape(thresholds, [-1, 1, 1])], axis=0)
+            tp = tf.reduce_sum(tf.cast(
+                tf.logical_and(preds, tf.expand_dims(labels, 0)),
+                tf.int64), axis=1)
+            fp = tf.reduce_sum(tf.cast(preds, tf.int64), axis=1) - tp
+            fn = tf.reduce_sum(tf.cast(labels, tf.int64), axis=0) - tp
+            self.metric_counts = local_variable(
+                'counts', [3, 1 + len(F1_THRESHOLDS), 28], tf.int64)
+            self.metric_loss = local_variable('loss', [2], tf.float64)
+            self.update_metrics = tf.group(
+                tf.assign_add(self.metric_counts, tf.stack([tp, fp, fn])),
+                tf.assign_add(self.metric_loss, tf.stack(
+                    [tf.cast(self.loss, tf.float64),
+                     tf.constant(1, tf.float64)])))
+            self.reset_metrics = tf.variables_initializer(
+                [self.metric_counts, self.metric_loss])
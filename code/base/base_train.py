@@ -1,4 +1,5 @@
 import tensorflow as tf
+from utils.profiler import StepProfiler
 
 
 class BaseTrain:
@@ -11,6 +12,10 @@ class BaseTrain:
         self.init = tf.group(tf.global_variables_initializer(),
                              tf.local_variables_initializer())
         self.sess.run(self.init)
+        # wall time of the phases of the training steps
+        if not hasattr(self.config, 'profile'):
+            self.config.profile = False
+        self.profiler = StepProfiler(self.config.profile)
 
     def train(self):
         for cur_epoch in range(
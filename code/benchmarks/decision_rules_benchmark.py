@@ -0,0 +1,133 @@
+import argparse
+import time
+import numpy as np
+from utils.metrics import macro_f1, prediction_counts, rule_counts
+from utils.predictor import get_pred_from_probas, \
+    get_pred_from_probas_threshold
+
+
+def loop_pred_from_probas(probas):
+    """
+    Former row by row version of get_pred_from_probas, with a stable sort
+    (the default one orders equal probas depending on the numpy kernel)
+    """
+    tmp_pred = np.round(probas)
+    for i in range(len(probas)):
+        if np.sum(tmp_pred[i]) == 0:
+            try:
+                tmp_pred[i, np.argmax(probas[i])[0]] = 1
+            except IndexError:
+                tmp_pred[i, np.argmax(probas[i])] = 1
+        elif np.sum(tmp_pred[i]) > 4:
+            ind = np.argsort(probas[i], kind='stable')[-4:]
+            tmp_pred[i] = np.zeros(28)
+            tmp_pred[i, ind] = 1
+    return tmp_pred
+
+
+def loop_pred_from_probas_threshold(probas, threshold=0.05):
+    """ Former row by row version of get_pred_from_probas_threshold """
+    tmp_pred = np.greater(probas, threshold)
+    for i in range(len(probas)):
+        if np.sum(tmp_pred[i]) == 0:
+            try:
+                tmp_pred[i, np.argmax(probas[i])[0]] = 1
+            except IndexError:
+                tmp_pred[i, np.argmax(probas[i])] = 1
+    return tmp_pred
+
+
+def random_probas(n, random_state=0):
+    """
+    Probabilities of n images with, as a model's, mostly no or a few
+    classes above 0.5 and a share of rows with more than 4.
+    """
+    rng = np.random.RandomState(random_state)
+    probas = rng.beta(0.3, 2.0, size=(n, 28))
+    crowded = rng.rand(n) < 0.05
+    probas[crowded] = rng.rand(int(crowded.sum()), 28)
+    return probas.astype(np.float32)
+
+
+def tied_probas(probas, random_state=0):
+    """
+    probas with ties: rounded to 0.01 and with a share of values saturated
+    to 1.0 (as float32 sigmoids)
+    """
+    rng = np.random.RandomState(random_state)
+    tied = np.round(probas, 2)
+    tied[rng.rand(*probas.shape) < 0.1] = 1.0
+    return tied.astype(np.float32)
+
+
+def check(probas, random_state=0):
+    """
+    Asserts that the batched rules give the former predictions, on probas
+    and on tied probas, and that the f1 of rule_counts (logged during the
+    training) is the f1 of the predictions of get_pred_from_probas
+    """
+    for probas in [probas, tied_probas(probas, random_state)]:
+        check_rules(probas)
+        labels = np.random.RandomState(random_state).rand(
+            *probas.shape) < 0.2
+        assert macro_f1(*rule_counts(labels, probas, [0.5]))[0] == \
+            macro_f1(*prediction_counts(
+                labels, get_pred_from_probas(probas))), 'rule_counts'
+
+
+def check_rules(probas):
+    """ Asserts that the batched rules give the former predictions """
+    for new, old in [(get_pred_from_probas, loop_pred_from_probas),
+                     (get_pred_from_probas_threshold,
+                      loop_pred_from_probas_threshold)]:
+        expected = old(probas)
+        result = new(probas)
+        assert result.dtype == expected.dtype, new.__name__
+        assert np.array_equal(result, expected), new.__name__
+    # a vector of equal per-class thresholds is the scalar threshold (in
+    # the type of probas: a scalar is compared in float32, a float64
+    # vector in float64, which differ for probas rounded to 0.05)
+    assert np.array_equal(
+        get_pred_from_probas(probas, np.full(28, 0.5, probas.dtype)),
+        get_pred_from_probas(probas))
+    assert np.array_equal(
+        get_pred_from_probas_threshold(probas,
+                                       np.full(28, 0.05, probas.dtype)),
+        get_pred_from_probas_threshold(probas))
+
+
+def best_time(fun, probas, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fun(probas)
+        times.append(time.perf_counter() - t)
+    return min(times)
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(
+        description='Checks the batched decision rules of utils.predictor '
+                    'against the former row by row versions and times them')
+    parser.add_argument('-s', '--sizes', default='10000 100000 1000000',
+                        help='Numbers of rows (space separated)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Runs per timing (the best one is reported)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parseArguments()
+    print('{:>9} {:>32} {:>10} {:>10} {:>8}'.format(
+        'rows', 'function', 'loop (s)', 'batch (s)', 'speedup'))
+    for n in [int(x) for x in args.sizes.split(' ')]:
+        probas = random_probas(n)
+        check(probas)
+        for new, old in [(get_pred_from_probas, loop_pred_from_probas),
+                         (get_pred_from_probas_threshold,
+                          loop_pred_from_probas_threshold)]:
+            t_old = best_time(old, probas, 1 if n > 100000 else args.repeat)
+            t_new = best_time(new, probas, args.repeat)
+            print('{:>9} {:>32} {:>10.3f} {:>10.4f} {:>7.0f}x'.format(
+                n, new.__name__, t_old, t_new, t_old / t_new))
+    print('Same predictions as the former versions')
@@ -0,0 +1,74 @@
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+from data_loader.data_generator import DataGenerator
+from data_loader.tf_data import TFDataPipeline
+from utils.config import get_config_from_json
+
+# Benchmark the input paths on CPU only
+CPU_ONLY = tf.ConfigProto(device_count={'GPU': 0})
+
+
+def bench_feed_dict(sess, data, num_batches):
+    """ Images/sec of the DataGenerator + placeholder (feed_dict) path """
+    images = tf.placeholder(tf.uint8, shape=[None, 4, None, None])
+    labels = tf.placeholder(tf.float32, shape=[None, 28])
+    # stands in for the model: forces the transfer of the whole batch
+    op = [tf.reduce_mean(tf.cast(images, tf.float32)),
+          tf.reduce_mean(labels)]
+    batches = data.batch_iterator(type='train')
+    n_images = 0
+    t_start = time.time()
+    for _ in range(num_batches):
+        batch_x, batch_y = next(batches)
+        sess.run(op, {images: batch_x, labels: batch_y})
+        n_images += len(batch_x)
+    batches.close()
+    return n_images / (time.time() - t_start)
+
+
+def bench_tf_data(sess, data, config, num_batches):
+    """ Images/sec of the tf.data input pipeline """
+    pipeline = TFDataPipeline(config)
+    images, labels = pipeline.get_next()
+    op = [tf.reduce_mean(tf.cast(images, tf.float32)),
+          tf.reduce_mean(labels),
+          tf.shape(images)[0]]
+    pipeline.start(sess, data, 'train')
+    n_images = 0
+    t_start = time.time()
+    for _ in range(num_batches):
+        n_images += sess.run(op)[2]
+    return n_images / (time.time() - t_start)
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(
+        description='Compares images/sec of the feed_dict and tf.data '
+                    'input paths on CPU')
+    parser.add_argument('-c', '--config', help='The Configuration file')
+    parser.add_argument('-n', '--num_batches', type=int, default=50,
+                        help='Number of batches timed per path')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parseArguments()
+    config, _ = get_config_from_json(args.config)
+    data = DataGenerator(config)
+    num_batches = min(args.num_batches, data.train_batches_per_epoch)
+    results = {}
+    with tf.Session(config=CPU_ONLY) as sess:
+        results['feed_dict'] = bench_feed_dict(sess, data, num_batches)
+    tf.reset_default_graph()
+    with tf.Session(config=CPU_ONLY) as sess:
+        results['tf_data'] = bench_tf_data(sess, data, config, num_batches)
+    print('batch_size: {}, batches: {}, loader_workers: {}, '
+          'prefetch_batches: {}'.format(config.batch_size, num_batches,
+                                        config.loader_workers,
+                                        config.prefetch_batches))
+    for name, images_per_sec in results.items():
+        print('{:>10}: {:8.1f} images/sec'.format(name, images_per_sec))
+    print('speedup tf_data / feed_dict: {:.2f}x'.format(
+        results['tf_data'] / np.maximum(results['feed_dict'], 1e-8)))
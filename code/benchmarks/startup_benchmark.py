@@ -0,0 +1,97 @@
+import argparse
+import json
+import os
+import runpy
+import subprocess
+import sys
+import time
+
+MAINS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                     'mains')
+# entry point -> (set its loader reads, whether it builds a network)
+ENTRY_POINTS = {
+    'baseline': ('train', False),
+    'train_main': ('train', True),
+    'predict_main': ('test', True),
+    'predict_from_several_main': ('test', True),
+}
+HEAVY_MODULES = ['tensorflow', 'sklearn', 'pandas']
+
+
+def measure(entry_point, config_file):
+    """
+    Startup latencies (s) of one entry point, in the current process:
+    its module-level imports, the creation of its data loader, the
+    construction of its model (if any) and the first batch.
+    """
+    split, builds_model = ENTRY_POINTS[entry_point]
+    timings = {}
+    t_start = time.time()
+    # runs the imports of the script but not its main
+    runpy.run_path(os.path.join(MAINS, entry_point + '.py'),
+                   run_name='startup_benchmark')
+    timings['import'] = time.time() - t_start
+
+    from data_loader.data_generator import DataGenerator, DataTestLoader
+    from utils.config import get_config_from_json
+    config, _ = get_config_from_json(config_file)
+    t = time.time()
+    if split == 'train':
+        data = DataGenerator(config)
+        batches = data.batch_iterator(type='train')
+    else:
+        data = DataTestLoader(config)
+        batches = data.batch_iterator()
+    timings['loader'] = time.time() - t
+
+    if builds_model:
+        from models.models import all_models
+        t = time.time()
+        all_models[config.model](config)
+        timings['model'] = time.time() - t
+
+    t = time.time()
+    next(batches)
+    timings['first_batch'] = time.time() - t
+    batches.close()
+    timings['total'] = time.time() - t_start
+    timings['modules'] = [m for m in HEAVY_MODULES if m in sys.modules]
+    return timings
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(
+        description='Reports the import and first-batch latencies of '
+                    'the entry points, each in a fresh interpreter')
+    parser.add_argument('-c', '--config', help='The Configuration file')
+    parser.add_argument('-e', '--entry_points',
+                        default=' '.join(ENTRY_POINTS),
+                        help='Entry points to time (space separated)')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parseArguments()
+    if args.child is not None:
+        # last line of the output, read by the parent process
+        print(json.dumps(measure(args.child, args.config)))
+        sys.exit(0)
+
+    print('{:>26} {:>8} {:>8} {:>8} {:>12} {:>8}  {}'.format(
+        'entry point', 'import', 'loader', 'model', 'first batch',
+        'total', 'heavy modules'))
+    for entry_point in args.entry_points.split(' '):
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child',
+             entry_point, '-c', args.config],
+            stdout=subprocess.PIPE, universal_newlines=True)
+        if out.returncode != 0:
+            print('{:>26} failed'.format(entry_point))
+            continue
+        timings = json.loads(out.stdout.strip().split('\n')[-1])
+        print('{:>26} {:>8.2f} {:>8.2f} {:>8} {:>12.2f} {:>8.2f}  {}'.format(
+            entry_point, timings['import'], timings['loader'],
+            '{:.2f}'.format(timings['model']) if 'model' in timings
+            else '-', timings['first_batch'], timings['total'],
+            ', '.join(timings['modules'])))
@@ -0,0 +1,110 @@
+import numpy as np
+
+
+def num_aug_per_class(class_counts, max_aug=8):
+    """
+    Number of transformations (rotations/reversions) of the images of each
+    class, from 0 (most represented class) to max_aug: the rarer the class,
+    the more transformations. Same rule as data_aug.py.
+
+    Args:
+        class_counts: number of images of each class
+        max_aug: maximum number of transformations of an image
+
+    Returns an int array with the number of transformations of each class
+    """
+    counts = np.asarray(class_counts, dtype=np.float64)
+    order = np.argsort(-counts, kind='stable')
+    top = counts[order[0]]
+    num_augs = np.zeros(len(counts), dtype=np.int64)
+    aug = 0
+    with np.errstate(divide='ignore'):
+        for i in order[1:]:
+            while top / counts[i] > aug and aug < max_aug \
+                    and counts[i] * 2 < top:
+                aug += 2
+            num_augs[i] = aug
+    return num_augs
+
+
+def num_aug_per_image(labels, num_augs):
+    """
+    Number of transformations of every image: the one of its most
+    represented class (the smallest of its classes).
+
+    Args:
+        labels: one-hot labels [n, 28] of the images
+        num_augs: number of transformations of each class
+            (see num_aug_per_class)
+    """
+    labels = np.asarray(labels) > 0
+    per_class = np.where(labels, np.asarray(num_augs)[None, :],
+                         np.iinfo(np.int64).max)
+    return np.where(labels.any(axis=1), per_class.min(axis=1), 0)
+
+
+def variant_names(num_aug):
+    """
+    Variants of an image with num_aug transformations, applied as pairs
+    'rot{k}' (k rotations by 90 degrees) and 'rev{k}' (the same, flipped
+    left-right), k = 1 .. num_aug / 2.
+    """
+    return [v + str(k + 1) for k in range(int(num_aug / 2))
+            for v in ['rot', 'rev']]
+
+
+def image_variants(labels, num_augs):
+    """
+    Augmented variants (see variant_names) of every image.
+
+    Args:
+        labels: one-hot labels [n, 28] of the images
+        num_augs: number of transformations of each class
+            (see num_aug_per_class)
+
+    Returns a list with the list of the variant names of every image
+    """
+    return [variant_names(n) for n in num_aug_per_image(labels, num_augs)]
+
+
+def variant_transform(variant):
+    """
+    Code 0-7 of the dihedral transform of a variant: the number of
+    rotations by 90 degrees (mod 4), plus 4 if the image is flipped.
+    """
+    code = int(variant[3:]) % 4
+    if variant[:3] == 'rev':
+        code += 4
+    return code
+
+
+def is_identity(variant):
+    """ Whether a variant is the image itself (e.g. 'rot4') """
+    return variant_transform(variant) == 0
+
+
+def dihedral(images, code):
+    """
+    Applies one dihedral transform to [..., H, W] images, as data_aug.py
+    does: np.rot90 then, for codes 4-7, np.fliplr. Returns a view.
+    """
+    images = np.rot90(images, code % 4, axes=(-2, -1))
+    if code >= 4:
+        images = images[..., ::-1]
+    return images
+
+
+def apply_transforms(images, transforms):
+    """
+    Transforms a batch of images in place.
+
+    Args:
+        images: [n, 4, H, W] array (with H == W)
+        transforms: code of the transform of every image (0 to keep it)
+    """
+    for code in np.unique(transforms):
+        if code == 0:
+            continue
+        selected = np.flatnonzero(transforms == code)
+        images[selected] = dihedral(images[selected], code)
+    return images
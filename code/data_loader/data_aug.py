@@ -1,200 +1,273 @@
+import glob
 import numpy as np
-import pandas as pd
 import os
 import sys
-import matplotlib.image as mpimg
+import zlib
 from joblib import Parallel, delayed
 import multiprocessing
 import time
 import pickle as pkl
 import argparse
 from PIL import Image
+from data_loader.aug_plan import dihedral, is_identity, num_aug_per_class, \
+    num_aug_per_image, variant_names, variant_transform
+from data_loader.file_index import CHANNELS, merge_fragments, \
+    png_is_valid, save_json, variant_paths, variant_signature, \
+    with_identities
+from data_loader.manifest import labels_from_bitmasks, load_manifest
+
+LABEL_NAMES = {
+    0: "Nucleoplasm",
+    1: "Nuclear membrane",
+    2: "Nucleoli",
+    3: "Nucleoli fibrillar center",
+    4: "Nuclear speckles",
+    5: "Nuclear bodies",
+    6: "Endoplasmic reticulum",
+    7: "Golgi apparatus",
+    8: "Peroxisomes",
+    9: "Endosomes",
+    10: "Lysosomes",
+    11: "Intermediate filaments",
+    12: "Actin filaments",
+    13: "Focal adhesion sites",
+    14: "Microtubules",
+    15: "Microtubule ends",
+    16: "Cytokinetic bridge",
+    17: "Mitotic spindle",
+    18: "Microtubule organizing center",
+    19: "Centrosome",
+    20: "Lipid droplets",
+    21: "Plasma membrane",
+    22: "Cell junctions",
+    23: "Mitochondria",
+    24: "Aggresome",
+    25: "Cytosol",
+    26: "Cytoplasmic bodies",
+    27: "Rods & rings"
+}
+
+
+def augmentation_plan(labels):
+    """
+    Computes the number of transformations of every image from the label
+    frequencies (rarer labels get more rotations/reversions) and the
+    variants to write.
+
+    Args:
+    labels: one-hot labels [n, 28] of the images
+
+    Returns the number of transformations of every image and the list of
+    the variants of every image to write (identities like 'rot4' are not
+    written, the loader serves them from the image itself)
+    """
+    class_counts = labels.sum(axis=0)
+    num_augs = num_aug_per_class(class_counts)
+    for c in np.argsort(-class_counts, kind='stable'):
+        print('{:>30}: {:>6} images, {} transformations'.format(
+            LABEL_NAMES[c], class_counts[c], num_augs[c]))
+    num_aug = num_aug_per_image(labels, num_augs)
+    variants = [[v for v in variant_names(n) if not is_identity(v)]
+                for n in num_aug]
+    return num_aug, variants
+
+
+def shard_of(image_id, num_shards):
+    """ Shard of an image: a stable hash (crc32) of its id, mod num_shards """
+    return zlib.crc32(image_id.encode('utf-8')) % num_shards
+
+
+def is_done(folder, image_id, names):
+    """
+    Whether all the variants of an image were written by a previous run:
+    their files exist and are complete PNGs (CRCs checked).
+    """
+    return all(png_is_valid(path, check_crc=True)
+               for variant in names
+               for path in variant_paths(folder, image_id, variant))
 
 
-def data_aug(data_folder, train_labels, label_names,
-             parallelization_bool):
+def augment_images(folder, image_ids, variants, compress_level,
+                   resume=False):
+    """
+    Decodes the 4 channels of each image once and writes all its variants
+    as uint8 grayscale ('L') PNGs. Every PNG is written to a temporary file
+    then renamed, an interrupted run leaves no truncated image.
+
+    Args:
+    folder: folder with the images (DATA_PATH/train)
+    image_ids: ids of the images to augment
+    variants: list of the variants (e.g. 'rot1') of every image
+    compress_level: zlib compression level of the PNGs (0-9)
+    resume: skip the images whose variants are already written and valid
+
+    Returns the checks of the variants for the manifest,
+    {id_variant: [total size, last mtime, valid]}, and the number of
+    skipped images
+    """
+    checks = {}
+    skipped = 0
+    for image_id, names in zip(image_ids, variants):
+        if not names:
+            continue
+        if resume and is_done(folder, image_id, names):
+            skipped += 1
+        else:
+            image = np.asarray([
+                np.asarray(Image.open(os.path.join(
+                    folder, image_id + '_' + c + '.png')).convert('L'))
+                for c in CHANNELS])
+            for variant in names:
+                transformed = dihedral(image, variant_transform(variant))
+                for channel, path in zip(transformed, variant_paths(
+                        folder, image_id, variant)):
+                    tmp_path = path + '.tmp'
+                    Image.fromarray(np.ascontiguousarray(channel), 'L').save(
+                        tmp_path, format='PNG', compress_level=compress_level)
+                    os.replace(tmp_path, path)
+        for variant in names:
+            checks[image_id + '_' + variant] = variant_signature(
+                variant_paths(folder, image_id, variant)) + [True]
+        # the identities (e.g. 'rot4') served from the image itself
+        for variant in with_identities(names):
+            if is_identity(variant):
+                checks[image_id + '_' + variant] = variant_signature(
+                    variant_paths(folder, image_id, variant)) + [
+                        is_done(folder, image_id, [variant])]
+    return checks, skipped
+
+
+def fragment_path(data_folder, shard, num_shards):
+    """ Path of the manifest fragment written by a shard """
+    return os.path.join(data_folder, 'train_aug_fragments',
+                        'shard-{:05d}-of-{:05d}.json'.format(shard,
+                                                             num_shards))
+
+
+def merge_shards(data_folder, num_shards=None):
+    """
+    Merges the manifest fragments of the shards into the manifest read by
+    the loader (DATA_PATH/train_aug_manifest.json, see
+    file_index.augmented_index).
+
+    Args:
+    data_folder: path to data folder
+    num_shards: number of shards of the job (default: the one of the
+        fragments found)
+    """
+    fragments = {}
+    for path in glob.glob(os.path.join(
+            data_folder, 'train_aug_fragments', 'shard-*-of-*.json')):
+        # shard-{i}-of-{n}.json
+        name = os.path.basename(path)[:-len('.json')].split('-')
+        fragments[int(name[1]), int(name[3])] = path
+    if num_shards is None:
+        if not fragments:
+            print('No manifest fragment found')
+            sys.exit(1)
+        num_shards = max(n for _, n in fragments)
+    shards = sorted(i for i, n in fragments if n == num_shards)
+    paths = [fragments[i, num_shards] for i in shards]
+    if not paths:
+        print('No manifest fragment of {} shards found'.format(num_shards))
+        sys.exit(1)
+    missing = sorted(set(range(num_shards)) - set(shards))
+    if missing:
+        print('WARN: no fragment of shards {} (of {}) - their variants '
+              'are not in the manifest'.format(missing, num_shards))
+    variants = merge_fragments(
+        os.path.join(data_folder, 'train'), paths,
+        os.path.join(data_folder, 'train_aug_manifest.json'))
+    print('Merged {} fragments: {} augmented images'.format(
+        len(paths), len(variants)))
+    return variants
+
+
+def data_aug(data_folder, image_ids, labels, parallelization_bool,
+             compress_level=6, chunk_size=64, shard=0, num_shards=1,
+             resume=False):
     """
     Function to augment data (by rotating and revolving images)
     Number of augmentations/sample depending on label frequency
-    Solves newly created images in folder defined by aug_data_name
+    Saves the newly created images in the train folder
+
+    The work can be split in num_shards jobs (e.g. a cluster job array),
+    each one augmenting the images whose id hashes to its shard. Every
+    shard writes a manifest fragment (see merge_shards).
 
     Args:
     data_folder: path to data folder
-    train_labels: dataframe with image name and label
-    label_names: dictionary index-label (see main)
+    image_ids: ids of the train images
+    labels: one-hot labels [n, 28] of the train images
     parallelization_bool: whether to parallelize process (bool)
         (default from argparse is False)
-
-    Returns a dataframe with all image names and associated labels
+    compress_level: zlib compression level of the PNGs (0-9)
+    chunk_size: number of images per parallel task
+    shard: index of the shard to augment (0 to num_shards - 1)
+    num_shards: number of shards
+    resume: skip the images already augmented by a previous run
     """
     print('Starting data augmentation')
-    print("Saving aug images to: {}".format(os.path.join(
-        data_folder, 'train')))
-
-    # Add 1 column/target: to 1 if in image's target label
-    train_labels_counts = train_labels.apply(fill_targets, axis=1)
-
-    # Computing number of augmentations needed for each image
-    num_augs = num_aug_perlabel(train_labels_counts)
-
-    filter_list = ['yellow', 'red', 'blue', 'green']
+    folder = os.path.join(data_folder, 'train')
+    print("Saving aug images to: {}".format(folder))
+
+    # the plan depends on the labels of all the images, not of the shard
+    num_aug, variants = augmentation_plan(labels)
+    selected = [i for i, image_id in enumerate(image_ids)
+                if shard_of(image_id, num_shards) == shard]
+    image_ids = [str(image_ids[i]) for i in selected]
+    variants = [variants[i] for i in selected]
+    print('Shard {}/{}: {} variants of {} images to write'.format(
+        shard, num_shards, sum(len(v) for v in variants),
+        sum(1 for v in variants if v)))
 
     t_start = time.time()
+    chunks = range(0, len(image_ids), chunk_size)
     # Parallelizing process
     if parallelization_bool:
         print("Parallelizing...")
-
         num_cores = multiprocessing.cpu_count()
-
-        Parallel(n_jobs=num_cores, verbose=1)(delayed(
-            processInput)(image_name, train_labels,
-                          filter_list, num_augs,
-                          data_folder) for image_name
-                                   in train_labels.Id)
-
+        results = Parallel(n_jobs=num_cores, verbose=1)(
+            delayed(augment_images)(
+                folder, image_ids[start:start + chunk_size],
+                variants[start:start + chunk_size], compress_level, resume)
+            for start in chunks)
     # If no Parallelization
     else:
         print('No parallelization')
-        rebalanced_images = []
-
-        counter = 0
-        t_start = time.time()
-
-        for image_name in train_labels.Id:
-            image_target = train_labels[train_labels.Id
-                                        == image_name].Target.values[0]
-
-            # Get minimum number of rotations/reversions needed
-            # (use value for most common target label)
-            max_num_rot = min(num_augs[label_names[int(num)]]
-                              for num in image_target.split(' '))
-
-            for i_rot in range(0, int(max_num_rot / 2)):
-                # Augmenting the image set
-                for colour in filter_list:
-                    image_path = os.path.join(data_folder, 'train',
-                                              image_name + '_' +
-                                              colour + '.png')
-                    # Rotating the image
-                    rot_image = np.rot90(mpimg.imread(image_path),
-                                         i_rot+1)
-                    # Convert array to image
-                    # Multiply by 255 because original values from 0 to 1
-                    img = Image.fromarray(rot_image * 255)
-                    # img.show()  # Uncomment to view image
-                    # Save newly created images
-                    # Convert image to RBG mode
-                    # (because original not supported by PNG)
-                    img.convert('P').save(
-                        os.path.join(data_folder, 'train', image_name +
-                                     '_rot' + str(i_rot+1) + '_' +
-                                     colour + '.png'))
-
-                    # Same for reversed image
-                    rev_image = np.fliplr(np.rot90(mpimg.imread(image_path),
-                                                   i_rot+1))
-                    img = Image.fromarray(rev_image * 255)
-                    # Save image
-                    img.convert('P').save(
-                        os.path.join(data_folder, 'train', image_name +
-                                     '_rev' + str(i_rot+1) +
-                                     '_' + colour + '.png'))
-
-                rebalanced_images.append([image_name + '_rot' +
-                                          str(i_rot+1), image_target])
-                rebalanced_images.append([image_name + '_rev' +
-                                          str(i_rot+1), image_target])
-
-            if counter % 100 == 0:
-                print('Processed {} images out of {}'.format(
-                    counter, len(train_labels)))
-            if counter % 500 == 0:
-                print("{}s. elapsed".format(
-                    time.time() - t_start))
-            counter += 1
-
+        results = []
+        for i, start in enumerate(chunks):
+            results.append(augment_images(
+                folder, image_ids[start:start + chunk_size],
+                variants[start:start + chunk_size], compress_level, resume))
+            if i % 10 == 0:
+                print('Processed {} images out of {} ({}s. elapsed)'.format(
+                    min(start + chunk_size, len(image_ids)),
+                    len(image_ids), time.time() - t_start))
+
+    checks = {}
+    for chunk_checks, _ in results:
+        checks.update(chunk_checks)
+    if resume:
+        print('Skipped {} images already augmented'.format(
+            sum(skipped for _, skipped in results)))
     t_end = time.time()
     print("Data augmentation took {}s.".format(t_end - t_start))
 
-    return None
-
-
-def processInput(image_name, train_labels, filter_list,
-                 num_augs, data_folder):
-    """
-    Base function to call parallelization of process
-    """
-    image_target = train_labels[
-        train_labels.Id == image_name].Target.values[0]
-    for colour in filter_list:
-        image_path = os.path.join(data_folder, 'train',
-                                  image_name + '_' +
-                                  colour + '.png')
-
-        max_num_rot = min(num_augs[label_names[int(num)]]
-                          for num in image_target.split(' '))
-
-        # Augmenting the image set
-        for i_rot in range(0, max_num_rot):
-            # Rotating the image
-            rot_image = np.rot90(mpimg.imread(image_path),
-                                 i_rot+1)
-            # Convert array to image
-            # Multiply by 255 because original values from 0 to 1
-            img = Image.fromarray(rot_image * 255)
-            # img.show()  # Uncomment to view image
-
-            # Save newly created images
-            # Convert image to RBG mode
-            # (because original - possible CMYK - not supported by PNG)
-            img.convert('P').save(
-                os.path.join(data_folder, 'train', image_name +
-                             '_rot' + str(i_rot+1) +
-                             '_' + colour + '.png'))
-
-            # Same for reversed image
-            rev_image = np.fliplr(np.rot90(mpimg.imread(image_path),
-                                           i_rot+1))
-            img = Image.fromarray(rev_image * 255)
-            # Save image
-            img.convert('P').save(
-                os.path.join(data_folder, 'train', image_name +
-                             '_rev' + str(i_rot+1) + '_' +
-                             colour + '.png'))
+    # Manifest fragment of the shard
+    path = fragment_path(data_folder, shard, num_shards)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    save_json({'shard': shard, 'num_shards': num_shards,
+               'variants': {image_id: names for image_id, names
+                            in zip(image_ids, variants) if names},
+               'checks': checks}, path)
+    print("Manifest fragment saved to: {}".format(path))
+    if num_shards == 1:
+        merge_shards(data_folder, num_shards)
 
     return None
 
 
-def num_aug_perlabel(train_labels):
-    """
-    Function to find number of augmentations necessary
-    """
-    sorted_label_values = train_labels.drop(
-        ["Id", "Target"], axis=1).sum(axis=0).\
-        sort_values(ascending=False)
-    print(sorted_label_values)
-    aug = 0
-    num_augs = {sorted_label_values.index[0]: 0}
-
-    for i in range(1, len(sorted_label_values)):
-        while (sorted_label_values[0] / sorted_label_values[i] > aug) \
-                & (aug < 8) & (
-                sorted_label_values[i] * 2 < sorted_label_values[0]):
-            aug += 2
-        num_augs[sorted_label_values.index[i]] = aug
-    return num_augs
-
-
-def fill_targets(row):
-    """
-    Function to get target count for each image
-    Fills cell with a 1 if target in label
-    """
-    for key in row.Target.split(" "):
-        row.loc[label_names[int(key)]] = 1
-    return row
-
-
 def save_obj(obj, name):
     """
     Shortcut function to save an object as pkl
@@ -214,10 +287,22 @@ def parseArguments():
     parser.add_argument("-p", "--parallelize",
                         default=False, action='store_true',
                         help='Parallelization (boolean type)')
+    parser.add_argument("--compress_level", type=int, default=6,
+                        help='zlib compression level of the PNGs (0-9, '
+                             'lower is faster to write and to read)')
+    parser.add_argument("--shard", type=str, default=None,
+                        help='i/n: augment the shard i (0 to n-1) of n '
+                             'of the images, split by image id')
+    parser.add_argument("--resume", default=False, action='store_true',
+                        help='Skip the images whose augmented files '
+                             'already exist and are valid')
+    parser.add_argument("--merge", default=False, action='store_true',
+                        help='Only merge the manifest fragments of the '
+                             'n shards (of --shard i/n, or the ones found)')
 
     # Print version
     parser.add_argument("--version", action="version",
-                        version='%(prog)s - Version 1.0')
+                        version='%(prog)s - Version 2.0')
 
     # Parse arguments
     args = parser.parse_args()
@@ -229,50 +314,6 @@ if __name__ == '__main__':
     if cwd is None:
         print("Set your DATA_PATH env first")
         sys.exit(1)
-    # Read csv file
-    tmp = pd.read_csv(os.path.abspath(os.path.join(cwd, 'train.csv')),
-                      delimiter=',', engine='python')
-    # A vector of images id.
-    image_ids = tmp["Id"]
-    n = len(image_ids)
-    # for each id sublist of the 4 filenames [batch_size, 4]
-    filenames = np.asarray([[
-        cwd + '/train/' + id + '_' + c + '.png'
-        for c in ['red', 'green', 'yellow', 'blue']
-    ] for id in image_ids])
-    # Labels
-    labels = tmp["Target"].values
-
-    label_names = {
-        0: "Nucleoplasm",
-        1: "Nuclear membrane",
-        2: "Nucleoli",
-        3: "Nucleoli fibrillar center",
-        4: "Nuclear speckles",
-        5: "Nuclear bodies",
-        6: "Endoplasmic reticulum",
-        7: "Golgi apparatus",
-        8: "Peroxisomes",
-        9: "Endosomes",
-        10: "Lysosomes",
-        11: "Intermediate filaments",
-        12: "Actin filaments",
-        13: "Focal adhesion sites",
-        14: "Microtubules",
-        15: "Microtubule ends",
-        16: "Cytokinetic bridge",
-        17: "Mitotic spindle",
-        18: "Microtubule organizing center",
-        19: "Centrosome",
-        20: "Lipid droplets",
-        21: "Plasma membrane",
-        22: "Cell junctions",
-        23: "Mitochondria",
-        24: "Aggresome",
-        25: "Cytosol",
-        26: "Cytoplasmic bodies",
-        27: "Rods & rings"
-    }
 
     # Parse the arguments
     args = parseArguments()
@@ -282,4 +323,22 @@ if __name__ == '__main__':
     for a in args.__dict__:
         print(str(a) + ": " + str(args.__dict__[a]))
 
-    data_aug(cwd, tmp, label_names, args.parallelize)
+    shard, num_shards = 0, 1
+    if args.shard is not None:
+        try:
+            shard, num_shards = [int(x) for x in args.shard.split('/')]
+            assert 0 <= shard < num_shards
+        except (ValueError, AssertionError):
+            print("--shard must be i/n with 0 <= i < n (got {})".format(
+                args.shard))
+            sys.exit(1)
+
+    if args.merge:
+        merge_shards(cwd, num_shards if args.shard is not None else None)
+        sys.exit(0)
+
+    # Ids and labels of train.csv (see manifest.py)
+    _, image_ids, bitmasks = load_manifest(cwd, 'train.csv')
+    data_aug(cwd, image_ids, labels_from_bitmasks(bitmasks),
+             args.parallelize, args.compress_level, shard=shard,
+             num_shards=num_shards, resume=args.resume)
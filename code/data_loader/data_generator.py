@@ -1,14 +1,87 @@
 import numpy as np
 import os
 import sys
-import pandas as pd
-from sklearn.preprocessing import MultiLabelBinarizer
-from sklearn.model_selection import train_test_split
-from sklearn.utils import resample
+import threading
 from PIL import Image
 from PIL import ImageFile
+from data_loader.aug_plan import apply_transforms, image_variants, \
+    num_aug_per_class, variant_transform
+from data_loader.file_index import ImagePaths, augmented_index
+from data_loader.manifest import load_manifest, labels_from_bitmasks, \
+    split_indices
+from data_loader.packed_store import select_store
+from data_loader.prefetch import prefetch, set_prefetch_defaults
 ImageFile.LOAD_TRUNCATED_IMAGES = True
-SKIP_CHECK = True
+
+
+class BatchBuffers:
+    """
+    A small ring of preallocated uint8 [batch_size, 4, H, W] buffers the
+    batches are decoded into, instead of allocating new arrays for every
+    batch. Enabled with "reuse_batch_buffers" in the config.
+
+    A batch is overwritten when the ring wraps around, i.e. it stays valid
+    while the next prefetch_batches + loader_workers batches are loaded:
+    copy it if it has to be kept longer.
+    """
+
+    def __init__(self, config):
+        self.batch_size = config.batch_size
+        self.buffers = [None] * (
+            config.prefetch_batches + config.loader_workers + 1)
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def get(self, n, image_size):
+        """ Returns the next buffer, as a view of its first n images """
+        with self.lock:
+            i = self.next
+            self.next = (i + 1) % len(self.buffers)
+            shape = (self.batch_size, 4, image_size, image_size)
+            if self.buffers[i] is None or self.buffers[i].shape != shape:
+                self.buffers[i] = np.empty(shape, dtype=np.uint8)
+        return self.buffers[i][:n]
+
+
+def served_image_size(images, filenames):
+    """
+    Side of the images served by a loader: the one of the packed store
+    if used, else the one of the PNG files (read from the first header).
+    """
+    if images is not None:
+        return images.shape[-1]
+    return Image.open(filenames[0][0]).size[0]
+
+
+def load_images(rows, images=None, filenames=None, out=None):
+    """
+    Loads the images of the given rows (indices or slice) as a
+    [n_rows, 4, H, W] uint8 array, from the packed store if images is
+    given, else by decoding the PNG files of filenames.
+
+    Args:
+        rows: row indices or slice of rows
+        images: packed store [N, 4, H, W] (see packed_store.py) or None
+        filenames: array [N, 4] of the PNG files of every row
+        out: optional buffer [n_rows, 4, H, W] the images are written to
+    """
+    if out is None:
+        if images is not None:
+            return images[rows]
+        return np.asarray(
+            [[np.asarray(Image.open(x)) for x in y]
+             for y in filenames[rows]])
+    if images is not None:
+        if isinstance(rows, slice):
+            out[...] = images[rows]
+        else:
+            # mode='clip' avoids a buffered copy of the result
+            np.take(images, rows, axis=0, out=out, mode='clip')
+        return out
+    for i, files in enumerate(filenames[rows]):
+        for c, x in enumerate(files):
+            out[i, c] = np.asarray(Image.open(x))
+    return out
 
 
 class DataGenerator:
@@ -39,126 +112,135 @@ class DataGenerator:
                 pass
         except AttributeError:
             self.config.augment = False
+        if not hasattr(self.config, 'virtual_augment'):
+            self.config.virtual_augment = False
+        if self.config.virtual_augment and self.config.augment:
+            print('WARN: augment and virtual_augment both set - '
+                  'using the virtual augmentation')
+            self.config.augment = False
+        if not hasattr(self.config, 'validate_augmented'):
+            # 'none', 'header' or 'crc' (see file_index.py)
+            self.config.validate_augmented = 'none'
+        try:
+            if self.config.packed:
+                pass
+        except AttributeError:
+            self.config.packed = False
+        if not hasattr(self.config, 'bootstrap_mode'):
+            # 'resample', 'multinomial' or 'poisson' (see bootstrap_weights)
+            self.config.bootstrap_mode = 'resample'
+        set_prefetch_defaults(self.config)
+        self.buffers = None
+        if hasattr(self.config, 'reuse_batch_buffers') and \
+                self.config.reuse_batch_buffers:
+            self.buffers = BatchBuffers(self.config)
 
-        # Read csv file
-        tmp = pd.read_csv(
-            os.path.abspath(os.path.join(cwd, 'train.csv')),
-            delimiter=',',
-            engine='python')
-        # A vector of images id.
-        image_ids = tmp["Id"]
+        # Ids and labels of train.csv, parsed once and cached in a
+        # binary manifest (see manifest.py)
+        manifest, self.image_ids, bitmasks = load_manifest(cwd, 'train.csv')
         data_path = os.path.join(cwd, 'train')
         print(data_path)
-        self.n = len(image_ids)
-
-        # For each id sublist of the 4 filenames [batch_size, 4]
-        self.filenames = np.asarray([[
-            os.path.join(cwd, 'train', id + '_' + c + '.png')
-            for c in ['red', 'green', 'yellow', 'blue']
-        ] for id in image_ids])
-        # Labels
-        self.labels = tmp["Target"].values
-        # To one-hot representation of labels
-        # e.g. before e.g. ['22 0' '12 23 0']
-        # after split [['22', '0'], ['12', '23', '0']]
-        # after binarize it is one hot representation
-        binarizer = MultiLabelBinarizer(classes=np.arange(28))
-        self.labels = [[int(c) for c in l.split(' ')] for l in self.labels]
-        self.labels = binarizer.fit_transform(self.labels)
-
-        # Build a validation set
+        self.n = len(self.image_ids)
+
+        # The 4 filenames of every row [n, 4], derived from the ids
+        self.filenames = ImagePaths(data_path, self.image_ids)
+        # One-hot representation of the labels
+        # e.g. bitmask 0b101 (labels '2 0') -> [1, 0, 1, 0, ..., 0]
+        self.labels = labels_from_bitmasks(bitmasks)
+
+        # Packed [N, 4, H, W] uint8 store or resized cache
+        # (see packed_store.py)
+        self.images = None
+        if self.config.packed or not self.config.augment:
+            self.images = select_store(cwd, 'train', self.image_ids,
+                                       self.config)
+        if self.images is not None and self.config.augment:
+            print('WARN: augmented images are not part of the '
+                  'packed store - using augment False')
+            self.config.augment = False
+        # Side of the served images (the model skips its resize
+        # if it matches input_size)
+        self.config.image_size = served_image_size(self.images,
+                                                   self.filenames)
+
+        # Build a validation set. The split is done on row indices
+        # (rows of self.filenames / self.images) so that batches can be
+        # served by either source.
         try:
-            self.train_filenames, self.val_filenames,\
-                self.train_labels, self.val_labels = train_test_split(
-                    self.filenames, self.labels,
-                    test_size=self.config.val_split,
-                    random_state=42)
+            val_split = self.config.val_split
         except AttributeError:
             print('WARN: val_split not set - using 0.1')
-            self.train_filenames, self.val_filenames,\
-                self.train_labels, self.val_labels = train_test_split(
-                    self.filenames, self.labels,
-                    test_size=0.1, random_state=42)
+            val_split = 0.1
+        self.train_indices, self.val_indices = split_indices(
+            manifest, self.n, val_split, random_state=42)
+        self.train_labels = self.labels[self.train_indices]
+        self.val_labels = self.labels[self.val_indices]
 
-        print("Shape of training data: {}".format(self.train_filenames.shape))
+        print("Shape of training data: {}".format(
+            (len(self.train_indices), 4)))
         print("Shape of training labels: {}".format(self.train_labels.shape))
 
+        # Rows added by the virtual augmentation are served from the
+        # image of base_rows[row] with the dihedral transform
+        # transforms[row] (None if not used)
+        self.base_rows = None
+        self.transforms = None
+
         # Get list of all possible images (incl. augmented if exist)
         data_train_folder = os.path.join(cwd, 'train')
 
         # Augment training data if specified in config file (and if possible)
         if self.config.augment:
             print("Getting augmented dataset...")
-            filter_list = ['yellow', 'red', 'blue', 'green']
-            aug_train_list = []
-            aug_train_labels = []
-
-            for i in range(0, self.train_filenames.shape[0]):
-                filename = self.train_filenames[i][0] \
-                    .rsplit('/')[-1].rsplit('_')[0]
-                print("Augmenting {}".format(filename))
-                temp_rot = []
-                temp_rev = []
-                counter = 1
-                while True:
-                    test_f = os.path.join(
-                        data_train_folder, filename + '_rot{}'.format(counter)
-                        + '_' + filter_list[0] + '.png')
-                    if os.path.isfile(test_f) is False:
-                        break
-                    temp_rot = [
-                        os.path.join(
-                            data_train_folder, filename +
-                            '_rot{}'.format(counter) + '_' + f + '.png')
-                        for f in filter_list
-                    ]
-                    temp_rev = [
-                        os.path.join(
-                            data_train_folder, filename +
-                            '_rev{}'.format(counter) + '_' + f + '.png')
-                        for f in filter_list
-                    ]
-                    flag = True
-                    if SKIP_CHECK is False:
-                        try:
-                            for fname in temp_rev:
-                                with open(fname, 'rb') as f:
-                                    # Check header of file
-                                    flag = flag and (f.read(4) == b'\x89PNG')
-                            for fname in temp_rot:
-                                with open(fname, 'rb') as f:
-                                    # Check header of file
-                                    flag = flag and (f.read(4) == b'\x89PNG')
-                        except IOError as e:
-                            print(e)
-                            flag = False
-                    if flag is True:
-                        aug_train_list.append(temp_rot)
-                        aug_train_labels.append(self.train_labels[i])
-                        aug_train_list.append(temp_rev)
-                        aug_train_labels.append(self.train_labels[i])
-                    else:
-                        print("corrupted images found")
-                        print(temp_rot)
-                        print(temp_rev)
-
-                    counter += 1
+            # One directory scan, cached in a manifest next to the data
+            variants = augmented_index(
+                data_train_folder,
+                os.path.join(cwd, 'train_aug_manifest.json'),
+                self.config.validate_augmented)
+            aug_rows = []
+            aug_variants = []
 
-            try:
-                # Append list of all aug filenames to training set
-                self.train_filenames = np.vstack((self.train_filenames,
-                                                  np.asarray(aug_train_list)))
+            for row in self.train_indices:
+                for variant in variants.get(self.image_ids[row], []):
+                    aug_rows.append(row)
+                    aug_variants.append(variant)
+
+            if aug_rows:
+                # Append the aug filenames to 'all' set
+                aug_indices = len(self.filenames) + np.arange(len(aug_rows))
+                self.filenames = self.filenames.with_variants(aug_rows,
+                                                              aug_variants)
+                # Append their rows to training set
+                self.train_indices = np.concatenate((self.train_indices,
+                                                     aug_indices))
                 self.train_labels = np.vstack((self.train_labels,
-                                               np.asarray(aug_train_labels)))
-                # Append list of all aug filenames to 'all' set
-                self.filenames = np.vstack((self.filenames,
-                                            np.asarray(aug_train_list)))
-                self.labels = np.vstack((self.labels,
-                                         np.asarray(aug_train_labels)))
-            # aug_train_list is empty (no aug data available)
-            except ValueError:
+                                               self.labels[aug_rows]))
+                self.labels = np.vstack((self.labels, self.labels[aug_rows]))
+            else:
                 print('No augmented data found. Please augment first')
 
+        if self.config.virtual_augment:
+            # Same variants as data_aug.py, transformed when loaded
+            variants = image_variants(
+                self.train_labels,
+                num_aug_per_class(self.labels.sum(axis=0)))
+            aug_rows = []
+            aug_transforms = []
+            for i, names in enumerate(variants):
+                aug_rows += [self.train_indices[i]] * len(names)
+                aug_transforms += [variant_transform(v) for v in names]
+            aug_rows = np.asarray(aug_rows, dtype=np.int64)
+            self.base_rows = np.concatenate((np.arange(self.n), aug_rows))
+            self.transforms = np.concatenate((
+                np.zeros(self.n, dtype=np.uint8),
+                np.asarray(aug_transforms, dtype=np.uint8)))
+            aug_indices = self.n + np.arange(len(aug_rows))
+            self.train_indices = np.concatenate((self.train_indices,
+                                                 aug_indices))
+            self.train_labels = np.vstack((self.train_labels,
+                                           self.labels[aug_rows]))
+            self.labels = np.vstack((self.labels, self.labels[aug_rows]))
+
         # New label frequency
         print("New label distribution: {}".format(
             self.train_labels.sum(axis=0)))
@@ -172,82 +254,252 @@ class DataGenerator:
         else:
             random_state = 42
         np.random.seed(random_state)
-        if hasattr(config, 'bootstrap_size'):
-            n_samples = int(config.bootstrap_size * self.n_train)
-            new_indices = resample(
-                np.arange(self.n_train),
-                n_samples=n_samples,
-                random_state=random_state)
-            self.train_filenames = self.train_filenames[new_indices]
+        # Multiplicity of every row in the bootstrap sample, given to the
+        # loss as example weights (None if not used)
+        self.example_weights = None
+        if hasattr(config, 'bootstrap_size') and \
+                self.config.bootstrap_mode == 'resample':
+            new_indices = self.bootstrap_sample(config.bootstrap_size,
+                                                random_state)
+            self.train_indices = self.train_indices[new_indices]
             self.train_labels = self.train_labels[new_indices]
             self.n_train = len(self.train_labels)
+        elif hasattr(config, 'bootstrap_size'):
+            # each image of the sample is read once per epoch
+            self.example_weights = self.bootstrap_weights(
+                config.bootstrap_size, random_state,
+                self.config.bootstrap_mode)
+            in_sample = self.example_weights[self.train_indices] > 0
+            self.train_indices = self.train_indices[in_sample]
+            self.train_labels = self.train_labels[in_sample]
+            self.n_train = len(self.train_labels)
 
         print('Size of training set is {}'.format(self.n_train))
         print('Size of validation set is {}'.format(self.n_val))
         # Compute class weigths
-        self.class_weights = (self.n_train) * np.reshape(
-            1 / np.sum(self.train_labels, axis=0), (1, -1))
+        if self.example_weights is None:
+            self.class_weights = (self.n_train) * np.reshape(
+                1 / np.sum(self.train_labels, axis=0), (1, -1))
+        else:
+            self.class_weights = self.weighted_class_weights(
+                self.example_weights)
         # Number batches per epoch
+        n_train_epoch = self.n_train
+        if self.example_weights is not None and \
+                hasattr(self.config, 'input_pipeline') and \
+                self.config.input_pipeline in ['tf_data', 'tfrecord']:
+            # the tf.data pipelines read every row of the weighted sample
+            # as many times as its weight (see repeat_weighted)
+            n_train_epoch = int(
+                self.example_weights[self.train_indices].sum())
         self.train_batches_per_epoch = int(
-            (self.n_train - 1) / self.config.batch_size) + 1
+            (n_train_epoch - 1) / self.config.batch_size) + 1
         self.val_batches_per_epoch = int(
             (self.n_val - 1) / self.config.batch_size) + 1
         self.all_batches_per_epoch = int(
             (self.n - 1) / self.config.batch_size) + 1
 
-    def batch_iterator(self, type='all'):
+    def bootstrap_sample(self, bootstrap_size, random_state):
         """
-        Generates a batch iterator for the dataset for one epoch.
+        Positions (in the training set) of a bootstrap sample of
+        bootstrap_size * n_train training images, drawn with replacement.
+        """
+        from sklearn.utils import resample
+        return resample(np.arange(self.n_train),
+                        n_samples=int(bootstrap_size * self.n_train),
+                        random_state=random_state)
+
+    def bootstrap_weights(self, bootstrap_size=None, random_state=42,
+                          mode='resample'):
+        """
+        Multiplicity of every row in a bootstrap sample of the training set
+        (1 for the training rows if bootstrap_size is None, 0 for the other
+        rows), used as example weights by the loss.
+
         Args:
-            type: 'all' for whole dataset batching (i.e. for CV for baseline)
-                  'train' for training set batching
-                   'val' for validation batching
-        Example:
-            data = DataGenerator(config)
-            training_batches = data.batch_iterator('train')
-            val_batches = data.batch_iterator('val')
-            all_batches = data.batch_iterator('all')
+            bootstrap_size: size of the sample, relative to n_train
+            random_state: seed of the sample
+            mode: 'resample' or 'multinomial' for the sample a DataGenerator
+                with this bootstrap_size and random_state trains on in
+                'resample' mode (bootstrap_size * n_train draws with
+                replacement), 'poisson' for independent
+                Poisson(bootstrap_size) multiplicities
+        """
+        if bootstrap_size is None:
+            positions = np.arange(self.n_train)
+        elif mode in ['resample', 'multinomial']:
+            positions = self.bootstrap_sample(bootstrap_size, random_state)
+        elif mode == 'poisson':
+            counts = np.random.RandomState(random_state).poisson(
+                bootstrap_size, self.n_train)
+            positions = np.repeat(np.arange(self.n_train), counts)
+        else:
+            print('Wrong bootstrap_mode {}'.format(mode))
+            exit(1)
+        return np.bincount(self.train_indices[positions],
+                           minlength=self.n).astype(np.float32)
+
+    def weighted_class_weights(self, weights):
+        """
+        Class weights (see class_weights) of a training set given as
+        example weights of the rows (see bootstrap_weights).
+        """
+        class_counts = weights.dot(self.labels)
+        return np.sum(weights) * np.reshape(1 / class_counts, (1, -1))
+
+    def repeat_weighted(self, rows, labels):
+        """
+        Repeats the rows of the training set as many times as their
+        example weight, for the tf.data pipelines (that can not weight
+        the loss), in a new random order.
+        """
+        if self.example_weights is None:
+            return rows, labels
+        repeated = np.repeat(np.arange(len(rows)),
+                             self.example_weights[rows].astype(np.int64))
+        repeated = np.random.permutation(repeated)
+        return rows[repeated], labels[repeated]
+
+    def epoch_rows(self, type='all'):
+        """
+        Shuffles the rows of one set for one epoch.
+        Args:
+            type: 'all', 'train' or 'val' (see batch_iterator)
+        Returns:
+            the shuffled row indices, their labels and the number of
+            batches of the epoch
         """
         if type == 'all':
-            filenames = self.filenames
+            indices = np.arange(self.n)
             labels = self.labels
             num_batches_per_epoch = self.all_batches_per_epoch
         elif type == 'train':
-            filenames = self.train_filenames
+            indices = self.train_indices
             labels = self.train_labels
             num_batches_per_epoch = self.train_batches_per_epoch
         elif type == 'val':
-            filenames = self.val_filenames
+            indices = self.val_indices
             labels = self.val_labels
             num_batches_per_epoch = self.val_batches_per_epoch
         else:
             print('Wrong type argument for batch_iterator')
             exit(1)
         # Shuffle the data at each epoch
-        n = len(labels)
-        shuffle_indices = np.random.permutation(np.arange(n))
-        shuffled_filenames = filenames[shuffle_indices]
-        shuffled_labels = labels[shuffle_indices]
+        shuffle_indices = np.random.permutation(np.arange(len(labels)))
+        return (indices[shuffle_indices], labels[shuffle_indices],
+                num_batches_per_epoch)
+
+    def file_rows(self, rows):
+        """
+        Rows of self.filenames (and of the packed store) the given rows are
+        read from, and the dihedral transforms to apply (see aug_plan.py).
+        """
+        if self.base_rows is None:
+            return rows, np.zeros(len(rows), dtype=np.uint8)
+        return self.base_rows[rows], self.transforms[rows]
+
+    def epoch_filenames(self, type='all'):
+        """
+        Shuffled filenames [n, 4], labels and transforms of one epoch,
+        to be read by the tf.data input pipeline (see tf_data.py).
+        """
+        rows, labels, _ = self.epoch_rows(type)
+        if type == 'train':
+            rows, labels = self.repeat_weighted(rows, labels)
+        rows, transforms = self.file_rows(rows)
+        return self.filenames[rows], labels, transforms
+
+    def row_counts(self, type='all'):
+        """
+        Number of times each row of self.filenames is part of one set
+        (0 if not in the set, more than 1 for rows duplicated by the
+        bootstrap resampling or the virtual augmentation), and the
+        transforms of these samples ordered by row.
+        Used by the TFRecord pipeline to select the records of a set.
+        """
+        if type == 'all':
+            indices = np.arange(self.n)
+        elif type == 'train':
+            indices, _ = self.repeat_weighted(self.train_indices,
+                                              self.train_labels)
+        elif type == 'val':
+            indices = self.val_indices
+        else:
+            print('Wrong type argument for row_counts')
+            exit(1)
+        rows, transforms = self.file_rows(indices)
+        counts = np.bincount(rows, minlength=len(self.filenames))
+        return (counts.astype(np.int64),
+                transforms[np.argsort(rows, kind='stable')])
+
+    def batch_iterator(self, type='all', with_rows=False,
+                       with_weights=False):
+        """
+        Generates a batch iterator for the dataset for one epoch.
+        Args:
+            type: 'all' for whole dataset batching (i.e. for CV for baseline)
+                  'train' for training set batching
+                   'val' for validation batching
+            with_rows: also yield the rows of the batch
+                (batch_x, batch_y, rows)
+            with_weights: also yield the example weights of the batch
+                (batch_x, batch_y, weights), 1 without weighted bootstrap
+        Example:
+            data = DataGenerator(config)
+            training_batches = data.batch_iterator('train')
+            val_batches = data.batch_iterator('val')
+            all_batches = data.batch_iterator('all')
+        """
+        shuffled_indices, shuffled_labels, num_batches_per_epoch = \
+            self.epoch_rows(type)
+        n = len(shuffled_labels)
+        batches = []
         for batch_num in range(num_batches_per_epoch):
             start_index = batch_num * self.config.batch_size
             end_index = min((batch_num + 1) * self.config.batch_size, n)
-            batchfile = shuffled_filenames[start_index:end_index]
-            batchlabel = shuffled_labels[start_index:end_index]
+            batches.append((shuffled_indices[start_index:end_index],
+                            shuffled_labels[start_index:end_index]))
 
+        def load(batch):
+            loaded = (self.load_batch(batch[0]), batch[1])
+            if with_rows:
+                loaded += (batch[0],)
+            if with_weights:
+                if self.example_weights is None:
+                    loaded += (np.ones(len(batch[0]), dtype=np.float32),)
+                else:
+                    loaded += (self.example_weights[batch[0]],)
+            return loaded
+
+        if self.config.prefetch_batches > 0:
+            # Loader exceptions are raised in the consumer
+            yield from prefetch(load, batches, self.config.prefetch_batches,
+                                self.config.loader_workers)
+            return
+        for batch in batches:
             try:
-                batchimages = np.asarray(
-                    [[np.asarray(Image.open(x)) for x in y]
-                     for y in batchfile])
-                # print(batchimages[0])
-                # print(np.asarray(
-                #    [[np.asarray(Image.open(x)) for x in y]
-                #     for y in batchfile])[0])
-                yield batchimages, batchlabel
+                yield load(batch)
             except Exception as e:
                 print("WARN: throwing away batch - {}".format(e))
 
-    def set_batch_iterator(self, type='all'):
-        train_iterator = self.batch_iterator(type=type)
+    def load_batch(self, rows):
+        """
+        Loads the images of the given rows as a [len(rows), 4, H, W] array,
+        either from the packed store or by decoding the PNG files.
+        """
+        out = None
+        if self.buffers is not None:
+            out = self.buffers.get(len(rows), self.config.image_size)
+        if self.base_rows is None:
+            return load_images(rows, self.images, self.filenames, out)
+        # each base image is read once, its variants are transformed
+        rows, transforms = self.file_rows(rows)
+        images = load_images(rows, self.images, self.filenames, out)
+        return apply_transforms(images, transforms)
+
+    def set_batch_iterator(self, type='all', with_weights=False):
+        train_iterator = self.batch_iterator(type=type,
+                                             with_weights=with_weights)
         self.train_iterator = train_iterator
 
 
@@ -271,27 +523,64 @@ class DataTestLoader:
             print("Set your DATA_PATH env first")
             sys.exit(1)
         self.config = config
-        self.result = pd.read_csv(cwd + '/sample_submission.csv')
-        self.image_ids = self.result["Id"]
+        self.cwd = cwd
+        self._result = None
+        # Ids of sample_submission.csv (see manifest.py)
+        _, self.image_ids, _ = load_manifest(cwd, 'sample_submission.csv')
         self.n = len(self.image_ids)
-        # for each id sublist of the 4 filenames [batch_size, 4]
-        self.filenames = np.asarray([[
-            os.path.join(cwd, 'test/', id + '_' + c + '.png')
-            for c in ['red', 'green', 'yellow', 'blue']
-        ] for id in self.image_ids])
+        # The 4 filenames of every row [n, 4], derived from the ids
+        self.filenames = ImagePaths(os.path.join(cwd, 'test'),
+                                    self.image_ids)
+        # Packed [N, 4, H, W] uint8 store or resized cache
+        # (see packed_store.py)
+        self.images = select_store(cwd, 'test', self.image_ids,
+                                   self.config)
+        self.config.image_size = served_image_size(self.images,
+                                                   self.filenames)
+        set_prefetch_defaults(self.config)
+        self.buffers = None
+        if hasattr(self.config, 'reuse_batch_buffers') and \
+                self.config.reuse_batch_buffers:
+            self.buffers = BatchBuffers(self.config)
+
+    @property
+    def result(self):
+        """ The sample submission dataframe, read when first used """
+        if self._result is None:
+            import pandas as pd
+            self._result = pd.read_csv(
+                os.path.join(self.cwd, 'sample_submission.csv'))
+        return self._result
+
+    @result.setter
+    def result(self, result):
+        self._result = result
 
-    def batch_iterator(self):
+    def batch_iterator(self, start=0):
         """
-        Generates a batch iterator for the dataset.
+        Generates a batch iterator for the dataset, from the row start.
         """
-        num_batches_per_epoch = int((self.n - 1) / self.config.batch_size) + 1
-        for batch_num in range(num_batches_per_epoch):
-            start_index = batch_num * self.config.batch_size
-            end_index = min((batch_num + 1) * self.config.batch_size, self.n)
-            batchfile = self.filenames[start_index:end_index]
-            batchimages = np.asarray(
-                [[np.asarray(Image.open(x)) for x in y] for y in batchfile])
-            yield batchimages
+        batches = [slice(i, min(i + self.config.batch_size, self.n))
+                   for i in range(start, self.n, self.config.batch_size)]
+
+        if self.config.prefetch_batches > 0:
+            yield from prefetch(self.load_batch, batches,
+                                self.config.prefetch_batches,
+                                self.config.loader_workers)
+            return
+        for batch in batches:
+            yield self.load_batch(batch)
+
+    def load_batch(self, rows):
+        """
+        Loads the images of the given rows (or slice of rows) as a
+        [n_rows, 4, H, W] array.
+        """
+        out = None
+        if self.buffers is not None:
+            n_rows = len(range(*rows.indices(self.n)))
+            out = self.buffers.get(n_rows, self.config.image_size)
+        return load_images(rows, self.images, self.filenames, out)
 
 
 if __name__ == '__main__':
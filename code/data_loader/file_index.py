@@ -0,0 +1,271 @@
+import json
+import os
+import struct
+import zlib
+import multiprocessing
+import numpy as np
+from data_loader.aug_plan import is_identity
+from concurrent.futures import ThreadPoolExecutor
+
+CHANNELS = ['red', 'green', 'yellow', 'blue']
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def png_is_valid(path, check_crc=False):
+    """
+    Checks that a file is a PNG: its signature and, if check_crc is set,
+    the CRC of every chunk up to IEND (i.e. the file is not truncated
+    nor corrupted).
+
+    Args:
+        path: path of the file
+        check_crc: whether to read the whole file and check the chunks
+    """
+    try:
+        with open(path, 'rb') as f:
+            if f.read(8) != PNG_SIGNATURE:
+                return False
+            if not check_crc:
+                return True
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                length, chunk_type = struct.unpack('>I4s', header)
+                data = f.read(length)
+                crc = f.read(4)
+                if len(data) < length or len(crc) < 4:
+                    return False
+                if zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff \
+                        != struct.unpack('>I', crc)[0]:
+                    return False
+                if chunk_type == b'IEND':
+                    return True
+    except IOError:
+        return False
+
+
+def variant_paths(folder, image_id, variant):
+    """
+    The 4 PNG files of one augmented variant (e.g. 'rot1'), the ones of
+    the image itself for the identity variants (e.g. 'rot4', not written
+    by data_aug.py)
+    """
+    if is_identity(variant):
+        return [os.path.join(folder, image_id + '_' + c + '.png')
+                for c in CHANNELS]
+    return [os.path.join(folder, image_id + '_' + variant + '_' + c + '.png')
+            for c in CHANNELS]
+
+
+class ImagePaths:
+    """
+    The [n, 4] PNG paths of the rows of a loader, derived from the image
+    ids when accessed instead of being stored as an array of n x 4 strings.
+    Rows after the ones of the ids are augmented variants of these images.
+
+    Indexing with an int gives the 4 paths of one row, with a slice or an
+    array of rows an array [len(rows), 4] of paths.
+    """
+
+    def __init__(self, folder, image_ids, base_rows=None, variants=None):
+        """
+        Args:
+            folder: folder with the images (e.g. DATA_PATH/train)
+            image_ids: vector of image ids
+            base_rows: rows (< len(image_ids)) of the augmented rows
+            variants: variant names (e.g. 'rot1') of the augmented rows
+        """
+        self.folder = folder
+        self.image_ids = image_ids
+        self.base_rows = [] if base_rows is None else base_rows
+        self.variants = [] if variants is None else variants
+
+    def __len__(self):
+        return len(self.image_ids) + len(self.variants)
+
+    def __getitem__(self, rows):
+        if isinstance(rows, slice):
+            rows = range(len(self))[rows]
+        elif np.ndim(rows) == 0:
+            return np.asarray(self._paths(range(len(self))[rows]))
+        return np.asarray([self._paths(r) for r in rows],
+                          dtype=str).reshape(-1, 4)
+
+    def _paths(self, row):
+        n = len(self.image_ids)
+        if row < n:
+            return [os.path.join(
+                self.folder, self.image_ids[row] + '_' + c + '.png')
+                for c in CHANNELS]
+        return variant_paths(self.folder,
+                             self.image_ids[self.base_rows[row - n]],
+                             self.variants[row - n])
+
+    def with_variants(self, base_rows, variants):
+        """ Paths with the given augmented variants as additional rows """
+        return ImagePaths(self.folder, self.image_ids,
+                          list(self.base_rows) + list(base_rows),
+                          list(self.variants) + list(variants))
+
+
+def scan_augmented(folder):
+    """
+    Lists the augmented images of a folder with a single os.scandir pass.
+
+    Returns a dict {image id: [variants]} of the variants ('rot{k}' and
+    'rev{k}') whose 4 channels exist, ordered rot1, rev1, rot2, rev2...
+    The identity 'rot{k}' variants are not written: they are listed if
+    their 'rev{k}' pair exists.
+    """
+    found = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            parts = entry.name[:-4].split('_')
+            if len(parts) != 3 or not entry.name.endswith('.png') or \
+                    parts[1][:3] not in ['rot', 'rev']:
+                continue
+            found.setdefault((parts[0], parts[1]), set()).add(parts[2])
+    variants = {}
+    for (image_id, variant), colours in found.items():
+        if len(colours.intersection(CHANNELS)) == 4:
+            variants.setdefault(image_id, []).append(variant)
+    return {image_id: with_identities(names)
+            for image_id, names in variants.items()}
+
+
+def with_identities(variants):
+    """
+    Sorts the variants of an image (rot1, rev1, rot2, rev2...) and adds
+    the identity 'rot{k}' variants, not written, if their 'rev{k}' pair is
+    in the list.
+    """
+    variants = set(variants)
+    for variant in list(variants):
+        rot = 'rot' + variant[3:]
+        if variant[:3] == 'rev' and is_identity(rot):
+            variants.add(rot)
+    return sorted(variants, key=lambda v: (int(v[3:]), v[:3] != 'rot'))
+
+
+def variant_signature(paths):
+    """ [total size, last mtime] of the files of a variant """
+    stats = [os.stat(p) for p in paths]
+    return [sum(s.st_size for s in stats),
+            max(s.st_mtime_ns for s in stats)]
+
+
+def _check_variant(paths, check_crc, cached):
+    """
+    Validates the 4 files of a variant, reusing the cached result
+    [total size, last mtime, valid] if the files did not change.
+    """
+    signature = variant_signature(paths)
+    if cached is not None and cached[:2] == signature:
+        return cached
+    return signature + [all(png_is_valid(p, check_crc) for p in paths)]
+
+
+def augmented_index(folder, manifest_path, check='none'):
+    """
+    Index of the augmented images of a folder, persisted as a json manifest
+    that is rebuilt when the modification time of the folder changes.
+
+    Args:
+        folder: folder with the images (e.g. DATA_PATH/train)
+        manifest_path: path of the json manifest
+        check: 'none', 'header' (PNG signature) or 'crc' (every chunk);
+            the results are cached in the manifest per variant
+
+    Returns a dict {image id: [variants]} of the valid augmented variants
+    """
+    mtime = os.stat(folder).st_mtime_ns
+    manifest = None
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    changed = manifest is None or manifest['mtime_ns'] != mtime
+    if changed:
+        print("Scanning {} for augmented images...".format(folder))
+        checks = manifest['checks'] if manifest is not None else {}
+        manifest = {'mtime_ns': mtime, 'variants': scan_augmented(folder),
+                    'checks': {}}
+    else:
+        checks = manifest['checks']
+    variants = manifest['variants']
+    dirty = changed
+
+    if check != 'none':
+        cached = checks.get(check, {})
+        results = {}
+        todo = []
+        for image_id, names in variants.items():
+            for name in names:
+                key = image_id + '_' + name
+                if not changed and key in cached:
+                    # folder untouched: trust the cached result
+                    results[key] = cached[key]
+                else:
+                    todo.append(key)
+        if todo:
+            print("Checking {} augmented images ({})...".format(
+                len(todo), check))
+            with ThreadPoolExecutor(
+                    max_workers=multiprocessing.cpu_count()) as executor:
+                checked = executor.map(
+                    lambda key: _check_variant(
+                        variant_paths(folder, *key.split('_')),
+                        check == 'crc', cached.get(key)),
+                    todo)
+                results.update(zip(todo, checked))
+            dirty = True
+        manifest['checks'][check] = results
+        corrupted = [key for key, result in results.items() if not result[2]]
+        if corrupted:
+            print("corrupted images found")
+            print(corrupted)
+        variants = {
+            image_id: [n for n in names if results[image_id + '_' + n][2]]
+            for image_id, names in variants.items()
+        }
+
+    if dirty:
+        save_json(manifest, manifest_path)
+    return variants
+
+
+def save_json(obj, path):
+    """ Writes a json file atomically (through a temporary file) """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def merge_fragments(folder, fragment_paths, manifest_path):
+    """
+    Merges the manifest fragments written by the shards of data_aug.py
+    ({'variants': {image id: [variants]}, 'checks': {id_variant:
+    [size, mtime, valid]}}) into the manifest of augmented_index, so that
+    the loader neither scans the folder nor checks the CRCs again.
+
+    Args:
+        folder: folder with the images (e.g. DATA_PATH/train)
+        fragment_paths: paths of the json fragments
+        manifest_path: path of the json manifest
+    """
+    variants = {}
+    checks = {}
+    for path in fragment_paths:
+        with open(path, 'r') as f:
+            fragment = json.load(f)
+        for image_id, names in fragment['variants'].items():
+            names = [n for n in names
+                     if fragment['checks'][image_id + '_' + n][2]]
+            if names:
+                variants[image_id] = with_identities(names)
+        checks.update(fragment['checks'])
+    manifest = {'mtime_ns': os.stat(folder).st_mtime_ns,
+                'variants': variants, 'checks': {'crc': checks}}
+    save_json(manifest, manifest_path)
+    return variants
@@ -0,0 +1,117 @@
+import hashlib
+import os
+import shutil
+import numpy as np
+
+NUM_CLASSES = 28
+
+
+def csv_digest(path):
+    """ sha1 of the content of a file (first 16 hex digits) """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()[:16]
+
+
+def manifest_folder(data_folder, csv_name):
+    """
+    Folder of the manifest of a csv file, e.g.
+    DATA_PATH/manifest/train_<sha1 of train.csv>
+    """
+    return os.path.join(data_folder, 'manifest', '{}_{}'.format(
+        os.path.splitext(csv_name)[0],
+        csv_digest(os.path.join(data_folder, csv_name))))
+
+
+def _save(path, array):
+    """ np.save to a temporary file, then atomically moved to path """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def build_manifest(csv_path, folder):
+    """
+    Parses a csv file (Id and optional Target columns) once and saves
+    the ids and the labels as bitmasks (bit c set if the image has
+    class c) to folder. Manifests of older versions of the csv are removed.
+    """
+    # pandas is only needed when the manifest is (re)built
+    import pandas as pd
+    print("Building the manifest of {}...".format(csv_path))
+    table = pd.read_csv(csv_path)
+    ids = np.asarray(table["Id"].tolist(), dtype=str)
+    bitmasks = np.zeros(len(ids), dtype=np.uint32)
+    if "Target" in table:
+        for i, target in enumerate(table["Target"].values):
+            for c in str(target).split(' '):
+                bitmasks[i] |= np.uint32(1 << int(c))
+
+    parent, name = os.path.split(folder)
+    tmp_folder = '{}.{}.tmp'.format(folder, os.getpid())
+    os.makedirs(tmp_folder)
+    np.save(os.path.join(tmp_folder, 'ids.npy'), ids)
+    np.save(os.path.join(tmp_folder, 'labels.npy'), bitmasks)
+    try:
+        os.replace(tmp_folder, folder)
+    except OSError:
+        # built meanwhile by another job
+        shutil.rmtree(tmp_folder)
+    prefix = name.rsplit('_', 1)[0] + '_'
+    for other in os.listdir(parent):
+        if other.startswith(prefix) and other != name and \
+                not other.endswith('.tmp'):
+            shutil.rmtree(os.path.join(parent, other), ignore_errors=True)
+
+
+def load_manifest(data_folder, csv_name):
+    """
+    Ids and labels of a csv file of the data folder (e.g. 'train.csv'),
+    read from its binary manifest (see build_manifest), which is built on
+    the first call and rebuilt whenever the content of the csv changes.
+
+    Args:
+        data_folder: path to data folder
+        csv_name: name of the csv file
+
+    Returns the manifest folder, the ids (memory-mapped) and the
+    label bitmasks (memory-mapped, see labels_from_bitmasks)
+    """
+    folder = manifest_folder(data_folder, csv_name)
+    if not os.path.isdir(folder):
+        build_manifest(os.path.join(data_folder, csv_name), folder)
+    ids = np.load(os.path.join(folder, 'ids.npy'), mmap_mode='r')
+    bitmasks = np.load(os.path.join(folder, 'labels.npy'), mmap_mode='r')
+    return folder, ids, bitmasks
+
+
+def labels_from_bitmasks(bitmasks, num_classes=NUM_CLASSES):
+    """ One-hot labels [n, num_classes] of label bitmasks """
+    bits = np.arange(num_classes, dtype=np.uint32)
+    return ((np.asarray(bitmasks)[:, None] >> bits) & 1).astype(np.int64)
+
+
+def split_indices(folder, n, val_split, random_state=42):
+    """
+    Train and validation row indices of a manifest, computed once with
+    sklearn's train_test_split and cached in the manifest folder.
+
+    Args:
+        folder: manifest folder (see load_manifest)
+        n: number of rows
+        val_split: fraction of the rows in the validation set
+        random_state: seed of the split
+    """
+    name = 'split_{}_{}'.format(val_split, random_state)
+    paths = [os.path.join(folder, name + '_' + s + '.npy')
+             for s in ['train', 'val']]
+    if not all(os.path.isfile(p) for p in paths):
+        from sklearn.model_selection import train_test_split
+        indices = train_test_split(np.arange(n), test_size=val_split,
+                                   random_state=random_state)
+        for path, rows in zip(paths, indices):
+            _save(path, rows)
+    return [np.load(p, mmap_mode='r') for p in paths]
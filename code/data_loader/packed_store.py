@@ -0,0 +1,234 @@
+import csv
+import numpy as np
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+from joblib import Parallel, delayed
+from PIL import Image
+from PIL import ImageFile
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+CHANNELS = ['red', 'green', 'yellow', 'blue']
+INTERPOLATIONS = {
+    'nearest': Image.NEAREST,
+    'bilinear': Image.BILINEAR,
+    'bicubic': Image.BICUBIC,
+    'lanczos': Image.LANCZOS,
+    'box': Image.BOX,
+}
+
+
+def _store_name(split, size, interpolation):
+    if size is None:
+        return split
+    return '{}_{}_{}'.format(split, size, interpolation)
+
+
+def store_path(data_folder, split, size=None, interpolation='bilinear'):
+    """
+    Path of the packed image array of one split
+
+    Args:
+    data_folder: path to data folder
+    split: 'train' or 'test'
+    size: side of the resized images (None for the original images)
+    interpolation: resampling method used for the resized images
+    """
+    return os.path.join(data_folder, 'packed', _store_name(
+        split, size, interpolation) + '.npy')
+
+
+def index_path(data_folder, split, size=None, interpolation='bilinear'):
+    """
+    Path of the id (and label) index of one packed split
+    """
+    return os.path.join(data_folder, 'packed', _store_name(
+        split, size, interpolation) + '.csv')
+
+
+def open_store(data_folder, split, ids, size=None,
+               interpolation='bilinear'):
+    """
+    Memory-maps a packed split and checks that its index matches
+    the ids the caller is going to use.
+
+    Args:
+    data_folder: path to data folder
+    split: 'train' or 'test'
+    ids: vector of image ids in the order of the csv file
+    size: side of the resized images (None for the original images)
+    interpolation: resampling method used for the resized images
+
+    Returns a read-only np.memmap of shape [N, 4, H, W]
+    """
+    path = store_path(data_folder, split, size, interpolation)
+    if not os.path.isfile(path):
+        print("No packed store found at {}. "
+              "Run data_loader/packed_store.py first".format(path))
+        sys.exit(1)
+    with open(index_path(data_folder, split, size, interpolation)) as f:
+        reader = csv.reader(f)
+        column = next(reader).index('Id')
+        index_ids = [line[column] for line in reader]
+    if not np.array_equal(np.asarray(index_ids), np.asarray(ids)):
+        print("The packed store {} does not match the csv file. "
+              "Please pack the data again".format(path))
+        sys.exit(1)
+    images = np.load(path, mmap_mode='r')
+    print("Using packed store {} {}".format(path, images.shape))
+    return images
+
+
+def set_store_defaults(config):
+    """
+    Defaults of the config entries select_store reads: packed False and
+    resize_interpolation 'bilinear'.
+    """
+    if not hasattr(config, 'packed'):
+        config.packed = False
+    if not hasattr(config, 'resize_interpolation'):
+        config.resize_interpolation = 'bilinear'
+
+
+def select_store(data_folder, split, ids, config):
+    """
+    Picks the store the loaders serve batches from: the resized cache
+    matching config.input_size (and config.resize_interpolation) if it was
+    built, else the original packed store if config.packed is set,
+    else None (the PNG files are decoded).
+    """
+    set_store_defaults(config)
+    if hasattr(config, 'input_size') and os.path.isfile(store_path(
+            data_folder, split, config.input_size,
+            config.resize_interpolation)):
+        return open_store(data_folder, split, ids, config.input_size,
+                          config.resize_interpolation)
+    if config.packed:
+        return open_store(data_folder, split, ids)
+    return None
+
+
+def _pack_chunk(path, image_folder, ids, start, size=None,
+                interpolation='bilinear'):
+    """
+    Decodes the 4 channels of the images ids[start:start+len(ids)]
+    (resized to size x size if size is given) and writes them to the
+    (already allocated) packed array.
+    """
+    images = np.load(path, mmap_mode='r+')
+    for i, image_id in enumerate(ids):
+        for c, colour in enumerate(CHANNELS):
+            img = Image.open(os.path.join(
+                image_folder, image_id + '_' + colour + '.png'))
+            if size is not None:
+                img = img.resize((size, size), INTERPOLATIONS[interpolation])
+            images[start + i, c] = np.asarray(img)
+    images.flush()
+    del images
+    return None
+
+
+def pack_split(data_folder, split, index, parallelization_bool,
+               size=None, interpolation='bilinear', chunk_size=256):
+    """
+    Function to pack all PNGs of a split into one contiguous
+    uint8 array of shape [N, 4, H, W] (channels in the order
+    red, green, yellow, blue) and saves the matching id index.
+    If size is given, the images are resized to size x size
+    (cache matched to the input_size of the models).
+
+    Args:
+    data_folder: path to data folder
+    split: 'train' or 'test'
+    index: dataframe with the image ids (and labels) in csv order
+    parallelization_bool: whether to parallelize process (bool)
+    size: side of the resized images (None to keep the original size)
+    interpolation: resampling method (see INTERPOLATIONS)
+    chunk_size: number of images decoded per job
+    """
+    image_folder = os.path.join(data_folder, split)
+    ids = index["Id"].values
+    n = len(ids)
+    if size is None:
+        first = np.asarray(Image.open(os.path.join(
+            image_folder, ids[0] + '_' + CHANNELS[0] + '.png')))
+        height, width = first.shape
+    else:
+        height, width = size, size
+    path = store_path(data_folder, split, size, interpolation)
+    tmp_path = path + '.tmp.npy'
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    print("Packing {} {} images to {}".format(n, split, path))
+
+    # Allocate the whole array on disk once, workers fill it in place
+    images = np.lib.format.open_memmap(
+        tmp_path, mode='w+', dtype=np.uint8, shape=(n, 4, height, width))
+    del images
+
+    t_start = time.time()
+    starts = range(0, n, chunk_size)
+    if parallelization_bool:
+        num_cores = multiprocessing.cpu_count()
+        Parallel(n_jobs=num_cores, verbose=1)(delayed(
+            _pack_chunk)(tmp_path, image_folder, ids[s:s + chunk_size], s,
+                         size, interpolation)
+            for s in starts)
+    else:
+        for s in starts:
+            _pack_chunk(tmp_path, image_folder, ids[s:s + chunk_size], s,
+                        size, interpolation)
+            print('Packed {} images out of {}'.format(
+                min(s + chunk_size, n), n))
+
+    # Only expose complete stores
+    os.replace(tmp_path, path)
+    index.to_csv(index_path(data_folder, split, size, interpolation),
+                 index=False)
+    print("Packing took {}s.".format(time.time() - t_start))
+
+
+def parseArguments():
+    # Create argument parser
+    parser = argparse.ArgumentParser()
+
+    # Arguments (optional)
+    parser.add_argument("-p", "--parallelize",
+                        default=False, action='store_true',
+                        help='Parallelization (boolean type)')
+    parser.add_argument("-s", "--splits",
+                        default='train test',
+                        help='Splits to pack (space separated)')
+    parser.add_argument("--size", type=int, default=None,
+                        help='Resize the images to size x size '
+                             '(default keeps the original size)')
+    parser.add_argument("--interpolation", default='bilinear',
+                        choices=sorted(INTERPOLATIONS.keys()),
+                        help='Resampling method used with --size')
+
+    # Parse arguments
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    # pandas is only needed to pack (the loaders read the manifest)
+    import pandas as pd
+    cwd = os.getenv("DATA_PATH")
+    if cwd is None:
+        print("Set your DATA_PATH env first")
+        sys.exit(1)
+
+    # Parse the arguments
+    args = parseArguments()
+
+    for split in args.splits.split(" "):
+        if split == 'train':
+            index = pd.read_csv(os.path.join(cwd, 'train.csv'))
+        else:
+            index = pd.read_csv(os.path.join(cwd, 'sample_submission.csv'))
+            index = index[["Id"]]
+        pack_split(cwd, split, index, args.parallelize,
+                   args.size, args.interpolation)
@@ -0,0 +1,50 @@
+import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+
+def set_prefetch_defaults(config):
+    """
+    Background prefetching is disabled unless prefetch_batches is set
+    in the config. loader_workers is the number of decoding threads.
+    """
+    if not hasattr(config, 'prefetch_batches'):
+        config.prefetch_batches = 0
+    if not hasattr(config, 'loader_workers'):
+        config.loader_workers = 1
+
+
+def prefetch(load_fn, items, depth=2, workers=1):
+    """
+    Runs load_fn over items in background threads and yields the
+    results in the order of items.
+
+    At most `depth` results are loaded or waiting to be consumed at any
+    time, so memory stays bounded while the consumer (e.g. sess.run)
+    overlaps with the decoding of the next batches. An exception raised
+    by load_fn is re-raised in the consumer when it reaches that item.
+    The threads are shut down when the iterator is exhausted, closed or
+    garbage collected.
+
+    Args:
+        load_fn: function loading one item (e.g. one batch)
+        items: iterable of the arguments passed to load_fn
+        depth: number of batches prefetched ahead of the consumer
+        workers: number of producer threads
+    """
+    executor = ThreadPoolExecutor(max_workers=workers)
+    items = iter(items)
+    pending = collections.deque(
+        executor.submit(load_fn, item)
+        for item in itertools.islice(items, max(depth, 1)))
+    try:
+        while pending:
+            result = pending.popleft().result()
+            # refill the queue before handing the batch to the consumer
+            for item in itertools.islice(items, 1):
+                pending.append(executor.submit(load_fn, item))
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
@@ -0,0 +1,248 @@
+import json
+import os
+import numpy as np
+import tensorflow as tf
+from data_loader.prefetch import set_prefetch_defaults
+
+
+def dihedral(image, transform):
+    """
+    Applies the dihedral transform of code transform (see aug_plan.py)
+    to a [H, W, C] image tensor: transform % 4 rotations by 90 degrees,
+    then a left-right flip if transform >= 4.
+    """
+    image = tf.image.rot90(image, transform % 4)
+    return tf.cond(transform >= 4,
+                   lambda: tf.image.flip_left_right(image),
+                   lambda: image)
+
+
+def decode_channels(pngs, config, image_size=512, transform=None):
+    """
+    Decodes the 4 PNG channels of one image to a [4, H, W] uint8 tensor,
+    resized to config.input_size if config.pipeline_resize is set.
+
+    Args:
+        pngs: string tensor of shape [4] with the encoded PNGs
+        config: a Bunch object
+        image_size: side of the images on disk
+        transform: optional int32 tensor, code of the dihedral transform
+            of the image (virtual augmentation)
+    """
+    channels = [tf.image.decode_png(pngs[c], channels=1) for c in range(4)]
+    image = tf.concat(channels, axis=2)
+    size = image_size
+    if config.pipeline_resize:
+        size = config.input_size
+        image = tf.image.resize_images(image, (size, size))
+        image = tf.saturate_cast(tf.round(image), tf.uint8)
+    if transform is not None:
+        image = dihedral(image, transform)
+    image = tf.transpose(image, perm=[2, 0, 1])
+    image.set_shape([4, size, size])
+    return image
+
+
+class TFDataPipeline:
+    """
+    Input pipeline built on tf.data, used instead of the input placeholders
+    when "input_pipeline" is "tf_data" in the config.
+
+    The shuffled file list of an epoch (from DataGenerator.epoch_filenames or
+    DataTestLoader.filenames) is given once when the iterator is started;
+    the PNGs are then read, decoded, stacked, batched and prefetched inside
+    the graph so the images never go through feed_dict.
+    """
+
+    def __init__(self, config, image_size=512):
+        """
+        Args:
+            config: a Bunch object (uses batch_size, loader_workers,
+                prefetch_batches, input_size and pipeline_resize)
+            image_size: side of the images on disk
+        """
+        self.config = config
+        self.image_size = image_size
+        set_prefetch_defaults(config)
+        if not hasattr(config, 'pipeline_resize'):
+            config.pipeline_resize = False
+        self.filenames = tf.placeholder(
+            tf.string, shape=[None, 4], name="filenames")
+        self.labels = tf.placeholder(
+            tf.float32, shape=[None, 28], name="filelabels")
+        self.transforms = tf.placeholder(
+            tf.int32, shape=[None], name="filetransforms")
+        dataset = tf.data.Dataset.from_tensor_slices(
+            (self.filenames, self.labels, self.transforms))
+        dataset = dataset.map(self._decode,
+                              num_parallel_calls=config.loader_workers)
+        dataset = dataset.batch(config.batch_size)
+        dataset = dataset.prefetch(max(config.prefetch_batches, 1))
+        self.iterator = dataset.make_initializable_iterator()
+
+    def get_next(self):
+        """ Returns the (images, labels) tensors of the next batch """
+        return self.iterator.get_next()
+
+    def start(self, sess, data, type, start=0):
+        """
+        Starts a new pass over one set.
+
+        Args:
+            sess: a tf session
+            data: a DataGenerator ('train', 'val', 'all')
+                or a DataTestLoader ('test')
+            type: the set to read
+            start: first row to read ('test' only)
+        """
+        if type == 'test':
+            filenames = data.filenames[start:]
+            labels = np.zeros((len(filenames), 28), dtype=np.float32)
+            transforms = np.zeros(len(filenames), dtype=np.int32)
+        else:
+            filenames, labels, transforms = data.epoch_filenames(type=type)
+        sess.run(self.iterator.initializer,
+                 {self.filenames: filenames, self.labels: labels,
+                  self.transforms: transforms})
+
+    def _decode(self, filenames, label, transform):
+        pngs = tf.stack([tf.read_file(filenames[c]) for c in range(4)])
+        return decode_channels(pngs, self.config, self.image_size,
+                               transform), label
+
+
+def shard_paths(data_folder, split, num_shards):
+    """ Paths of the TFRecord shards of one split """
+    return [os.path.join(data_folder, 'tfrecords',
+                         '{}-{:05d}-of-{:05d}.tfrecord'.format(
+                             split, i, num_shards))
+            for i in range(num_shards)]
+
+
+def meta_path(data_folder, split):
+    """ Path of the json file describing the shards of one split """
+    return os.path.join(data_folder, 'tfrecords', split + '.json')
+
+
+class TFRecordPipeline:
+    """
+    Input pipeline reading the sharded TFRecords written by
+    tfrecord_writer.py, used when "input_pipeline" is "tfrecord".
+
+    Each record holds the row of the image in the DataGenerator (or in the
+    test csv), its 4 encoded PNG channels and its label. Training and
+    validation read the shards in parallel (interleaved, shuffled); each
+    record is repeated as many times as its row appears in the set, so the
+    train/val split, the augmented rows and the bootstrap_size resampling
+    of the DataGenerator are kept; with virtual_augment the repeats of a
+    record are given their dihedral transforms. The test set is read in csv
+    order.
+    """
+
+    def __init__(self, config, image_size=512):
+        """
+        Args:
+            config: a Bunch object (uses batch_size, loader_workers,
+                prefetch_batches, shuffle_buffer, input_size and
+                pipeline_resize)
+            image_size: side of the images on disk
+        """
+        self.config = config
+        self.image_size = image_size
+        self.data_folder = os.getenv("DATA_PATH")
+        set_prefetch_defaults(config)
+        if not hasattr(config, 'pipeline_resize'):
+            config.pipeline_resize = False
+        if not hasattr(config, 'shuffle_buffer'):
+            config.shuffle_buffer = 1024
+        self.shards = tf.placeholder(tf.string, shape=[None], name="shards")
+        self.counts = tf.placeholder(tf.int64, shape=[None], name="counts")
+        # transforms of the samples of the set, ordered by row, and offset
+        # of the first sample of every row
+        self.offsets = tf.placeholder(tf.int64, shape=[None], name="offsets")
+        self.transforms = tf.placeholder(
+            tf.int32, shape=[None], name="transforms")
+        self.seed = tf.placeholder(tf.int64, shape=[], name="seed")
+
+        shuffled = self._build(shuffle=True)
+        ordered = self._build(shuffle=False)
+        self.iterator = tf.data.Iterator.from_structure(
+            shuffled.output_types, shuffled.output_shapes)
+        self.shuffled_init = self.iterator.make_initializer(shuffled)
+        self.ordered_init = self.iterator.make_initializer(ordered)
+
+    def get_next(self):
+        """ Returns the (images, labels) tensors of the next batch """
+        return self.iterator.get_next()
+
+    def start(self, sess, data, type, start=0):
+        """
+        Starts a new pass over one set.
+
+        Args:
+            sess: a tf session
+            data: a DataGenerator ('train', 'val', 'all')
+                or a DataTestLoader ('test')
+            type: the set to read
+            start: first row to read ('test' only)
+        """
+        split = 'test' if type == 'test' else 'train'
+        with open(meta_path(self.data_folder, split), 'r') as f:
+            meta = json.load(f)
+        n = len(data.filenames)
+        if meta['n'] != n:
+            print("The {} TFRecords hold {} images but the loader has {}. "
+                  "Write them again with the same augment "
+                  "setting".format(split, meta['n'], n))
+            exit(1)
+        if type == 'test':
+            # the rows before start are read but not kept
+            counts = np.ones(n, dtype=np.int64)
+            counts[:start] = 0
+            transforms = np.zeros(n - start, dtype=np.int32)
+        else:
+            counts, transforms = data.row_counts(type=type)
+        sess.run(
+            self.ordered_init if type == 'test' else self.shuffled_init,
+            {self.shards: shard_paths(self.data_folder, split,
+                                      meta['num_shards']),
+             self.counts: counts,
+             self.offsets: np.cumsum(counts) - counts,
+             self.transforms: transforms,
+             self.seed: np.random.randint(2**31)})
+
+    def _build(self, shuffle):
+        files = tf.data.Dataset.from_tensor_slices(self.shards)
+        if shuffle:
+            files = files.shuffle(1024, seed=self.seed)
+        dataset = files.apply(tf.contrib.data.parallel_interleave(
+            tf.data.TFRecordDataset,
+            cycle_length=self.config.loader_workers if shuffle else 1,
+            sloppy=shuffle))
+        dataset = dataset.map(self._parse)
+        # keep each record as many times as its row is in the set
+        dataset = dataset.flat_map(self._repeat)
+        if shuffle:
+            dataset = dataset.shuffle(self.config.shuffle_buffer,
+                                      seed=self.seed)
+        dataset = dataset.map(
+            lambda pngs, label, transform: (
+                decode_channels(pngs, self.config, self.image_size,
+                                transform), label),
+            num_parallel_calls=self.config.loader_workers)
+        dataset = dataset.batch(self.config.batch_size)
+        return dataset.prefetch(max(self.config.prefetch_batches, 1))
+
+    def _repeat(self, row, pngs, label):
+        offset = tf.gather(self.offsets, row)
+        return tf.data.Dataset.range(tf.gather(self.counts, row)).map(
+            lambda i: (pngs, label,
+                       tf.gather(self.transforms, offset + i)))
+
+    def _parse(self, record):
+        features = tf.parse_single_example(record, {
+            'row': tf.FixedLenFeature([], tf.int64),
+            'image': tf.FixedLenFeature([4], tf.string),
+            'label': tf.FixedLenFeature([28], tf.float32),
+        })
+        return features['row'], features['image'], features['label']
@@ -0,0 +1,124 @@
+import numpy as np
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+import tensorflow as tf
+from joblib import Parallel, delayed
+from data_loader.data_generator import DataGenerator, DataTestLoader
+from data_loader.tf_data import shard_paths, meta_path
+from utils.config import get_config_from_json
+
+
+def _write_shard(path, rows, filenames, labels):
+    """
+    Writes one shard: one tf.train.Example per image with its row,
+    its 4 encoded PNG channels (read as is, no re-encoding) and its label.
+    """
+    tmp_path = path + '.tmp'
+    with tf.python_io.TFRecordWriter(tmp_path) as writer:
+        for row, files, label in zip(rows, filenames, labels):
+            pngs = []
+            for fname in files:
+                with open(fname, 'rb') as f:
+                    pngs.append(f.read())
+            example = tf.train.Example(features=tf.train.Features(feature={
+                'row': tf.train.Feature(
+                    int64_list=tf.train.Int64List(value=[row])),
+                'image': tf.train.Feature(
+                    bytes_list=tf.train.BytesList(value=pngs)),
+                'label': tf.train.Feature(
+                    float_list=tf.train.FloatList(value=label)),
+            }))
+            writer.write(example.SerializeToString())
+    # Only expose complete shards
+    os.replace(tmp_path, path)
+    return None
+
+
+def write_split(data_folder, split, filenames, labels, num_shards,
+                parallelization_bool, augment=False):
+    """
+    Function to write all images of a split into num_shards TFRecord files
+    (rows split in contiguous blocks) and a json file describing them.
+
+    Args:
+    data_folder: path to data folder
+    split: 'train' or 'test'
+    filenames: array [n, 4] with the 4 PNGs of every row
+    labels: one-hot labels [n, 28] of every row
+    num_shards: number of TFRecord files to write
+    parallelization_bool: whether to parallelize process (bool)
+    augment: whether filenames include the augmented images
+    """
+    n = len(filenames)
+    paths = shard_paths(data_folder, split, num_shards)
+    if not os.path.exists(os.path.dirname(paths[0])):
+        os.makedirs(os.path.dirname(paths[0]))
+    print("Writing {} {} images to {} shards in {}".format(
+        n, split, num_shards, os.path.dirname(paths[0])))
+
+    t_start = time.time()
+    shards = np.array_split(np.arange(n), num_shards)
+    if parallelization_bool:
+        num_cores = multiprocessing.cpu_count()
+        Parallel(n_jobs=num_cores, verbose=1)(delayed(
+            _write_shard)(path, rows, filenames[rows], labels[rows])
+            for path, rows in zip(paths, shards))
+    else:
+        for i, (path, rows) in enumerate(zip(paths, shards)):
+            _write_shard(path, rows, filenames[rows], labels[rows])
+            print('Written {} shards out of {}'.format(i + 1, num_shards))
+
+    with open(meta_path(data_folder, split), 'w') as f:
+        json.dump({'n': n, 'num_shards': num_shards, 'augment': augment}, f)
+    print("Writing took {}s.".format(time.time() - t_start))
+
+
+def parseArguments():
+    # Create argument parser
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-c", "--config",
+                        help='The Configuration file (for augment)')
+    # Arguments (optional)
+    parser.add_argument("-n", "--num_shards", type=int, default=64,
+                        help='Number of shards per split')
+    parser.add_argument("-s", "--splits",
+                        default='train test',
+                        help='Splits to write (space separated)')
+    parser.add_argument("-p", "--parallelize",
+                        default=False, action='store_true',
+                        help='Parallelization (boolean type)')
+
+    # Parse arguments
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    cwd = os.getenv("DATA_PATH")
+    if cwd is None:
+        print("Set your DATA_PATH env first")
+        sys.exit(1)
+
+    # Parse the arguments
+    args = parseArguments()
+    config, _ = get_config_from_json(args.config)
+
+    for split in args.splits.split(" "):
+        if split == 'train':
+            # all files of the DataGenerator, incl. augmented ones (the
+            # virtual augmentation reuses the records of the base images)
+            data = DataGenerator(config)
+            n = len(data.filenames)
+            write_split(cwd, split, data.filenames,
+                        data.labels[:n].astype(np.float32), args.num_shards,
+                        args.parallelize, config.augment)
+        else:
+            data = DataTestLoader(config)
+            write_split(cwd, split, data.filenames,
+                        np.zeros((data.n, 28), dtype=np.float32),
+                        args.num_shards, args.parallelize)
@@ -0,0 +1,120 @@
+import tensorflow as tf
+import numpy as np
+
+from data_loader.data_generator import DataGenerator
+from models.models import all_models
+from utils.config import process_config
+from utils.metrics import F1_THRESHOLDS, best_class_thresholds, \
+    macro_f1, prediction_counts
+from utils.predictor import get_pred_from_probas, \
+    get_pred_from_probas_threshold, save_thresholds
+from utils.proba_cache import ProbaCache
+from utils.utils import get_args
+
+
+def val_probas(config, checkpoint_nb, cache=None):
+    """
+    Probabilities and labels of the validation set (in the order of
+    data.val_indices), predicted by the model of a config restored from
+    its checkpoint.
+
+    Args:
+        config: config of the model
+        checkpoint_nb: number of the checkpoint (None for the latest)
+        cache: ProbaCache of the probabilities of the models (None to
+            always predict)
+    """
+    data = DataGenerator(config)
+    # the validation batches are fed
+    config.input_pipeline = 'feed_dict'
+
+    def predict():
+        graph = tf.Graph()
+        with graph.as_default():
+            sess = tf.Session(graph=graph)
+            try:
+                ModelInit = all_models[config.model]
+                model = ModelInit(config)
+            except AttributeError:
+                print("The model to use is not specified in the config file")
+                exit(1)
+            model.load(sess, checkpoint_nb)
+            # the validation batches are shuffled, their rows are put back
+            # in the order of val_indices
+            position = np.full(data.n, -1, dtype=np.int64)
+            position[data.val_indices] = np.arange(data.n_val)
+            probas = np.zeros((data.n_val, 28), dtype=np.float32)
+            for batch_x, batch_y, rows in data.batch_iterator(
+                    type='val', with_rows=True):
+                probas[position[rows]] = sess.run(model.out, {
+                    model.input: batch_x,
+                    model.label: batch_y,
+                    model.is_training: False
+                })
+            sess.close()
+        return probas
+
+    if cache is None:
+        return predict(), data.val_labels
+    key = cache.key(config, checkpoint_nb, 'val',
+                    data.image_ids[data.val_indices])
+    description = {'exp_name': config.exp_name, 'split': 'val',
+                   'checkpoint': 'latest' if checkpoint_nb is None
+                   else checkpoint_nb}
+    return cache.cached(key, predict, description), data.val_labels
+
+
+def main():
+    """
+    Chooses per-class thresholds maximizing the validation f1 of a model
+    (or of the mean probabilities of several models, each with its config
+    and checkpoint) and saves them as a json vector, to predict with
+    predict_main.py or predict_from_several_main.py -th <file>.
+    """
+    try:
+        args = get_args()
+        config_array = [process_config(x) for x in args.config.split(" ")]
+        if args.checkpoint_nb is None:
+            check_array = [None] * len(config_array)
+        else:
+            check_array = args.checkpoint_nb.split(" ")
+        if args.thresholds:
+            outfile = args.thresholds
+        else:
+            outfile = config_array[0].checkpoint_dir + 'thresholds.json'
+    except Exception:
+        print("missing or invalid arguments")
+        raise
+
+    cache = None
+    if args.proba_cache is not None:
+        cache = ProbaCache(dtype=args.proba_cache)
+    probas = None
+    for config, check in zip(config_array, check_array):
+        model_probas, labels = val_probas(config, check, cache)
+        if probas is None:
+            probas = model_probas.copy()
+        else:
+            probas += model_probas
+    probas /= len(config_array)
+
+    thresholds, class_f1 = best_class_thresholds(labels, probas)
+    for c, (threshold, f1) in enumerate(zip(thresholds, class_f1)):
+        print('class {:>2}: threshold {:.4f}, f1 {:.4f}'.format(
+            c, threshold, f1))
+    print('val macro f1 - rule: {:.4f}, {} - per-class thresholds: '
+          '{:.4f}'.format(
+              macro_f1(*prediction_counts(
+                  labels, get_pred_from_probas(probas))),
+              ', '.join('{}: {:.4f}'.format(t, macro_f1(
+                  *prediction_counts(labels, probas > t)))
+                  for t in F1_THRESHOLDS),
+              macro_f1(*prediction_counts(
+                  labels, get_pred_from_probas_threshold(
+                      probas, thresholds)))))
+    save_thresholds(outfile, thresholds)
+    print("Thresholds saved to {}".format(outfile))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,158 @@
 import tensorflow as tf
 
 from data_loader.data_generator import DataTestLoader
+from data_loader.packed_store import set_store_defaults
 from models.models import all_models
 from utils.config import process_config
 from utils.utils import get_args
-from utils.predictor import Predictor, get_pred_from_probas_threshold
+from utils.predictor import Predictor, SubmissionWriter, \
+    get_pred_from_probas_threshold, load_thresholds
+from utils.proba_cache import ProbaCache
 import os
 import numpy as np
-from sklearn.preprocessing import MultiLabelBinarizer
+
+# config entries that define the test batches, they must be the same for
+# all models to share them
+DATA_KEYS = ['packed', 'input_size', 'resize_interpolation']
+
+
+def member_description(config, check):
+    """ Description of the cached test probabilities of a model """
+    return {'exp_name': config.exp_name, 'split': 'test',
+            'checkpoint': 'latest' if check is None else check}
+
+
+def predict_single_pass(config_array, check_array, one_hot, cache=None):
+    """
+    Mean predictions of several models on the test set in one pass: all
+    the models are restored up front (each in its own graph and session),
+    every test batch is read once and fed to each model, and the sum of
+    their predictions is accumulated in a float32 [n, 28] array.
+
+    Args:
+        config_array: the configs of the models
+        check_array: their checkpoint numbers
+        one_hot: average the predictions (probas > 0.05) of the models
+            rather than their probabilities
+        cache: ProbaCache of the probabilities of the models (None to
+            always predict)
+    """
+    for config in config_array:
+        # a default set explicitly serves the same images as an unset one
+        set_store_defaults(config)
+    for key in DATA_KEYS:
+        values = set(str(getattr(config, key, None))
+                     for config in config_array)
+        if len(values) > 1:
+            print("All configs must have the same {} to share the test "
+                  "batches (got {})".format(key, values))
+            exit(1)
+    testIterator = DataTestLoader(config_array[0])
+    total = np.zeros((testIterator.n, 28), dtype=np.float32)
+    members = []
+    for config, check in zip(config_array, check_array):
+        # the test batches are fed
+        config.input_pipeline = 'feed_dict'
+        config.image_size = config_array[0].image_size
+        key = None
+        if cache is not None:
+            key = cache.key(config, check, 'test', testIterator.image_ids)
+            cached = cache.load(key)
+            if cached is not None:
+                print('Loaded the cached probabilities of {}'.format(
+                    config.exp_name))
+                if one_hot:
+                    cached = get_pred_from_probas_threshold(cached)
+                total += cached
+                continue
+        graph = tf.Graph()
+        with graph.as_default():
+            sess = tf.Session(graph=graph)
+            try:
+                ModelInit = all_models[config.model]
+                model = ModelInit(config)
+            except AttributeError:
+                print("The model to use is not specified in the config file")
+                exit(1)
+            model.load(sess, check)
+        # probabilities of the model, kept to be cached
+        member_probas = None
+        if key is not None:
+            member_probas = np.zeros((testIterator.n, 28), dtype=np.float32)
+        members.append((sess, model, member_probas,
+                        key, member_description(config, check)))
+
+    start = 0
+    batches = testIterator.batch_iterator() if members else []
+    for batch_imgs in batches:
+        rows = slice(start, start + len(batch_imgs))
+        for sess, model, member_probas, _, _ in members:
+            batch_probas = sess.run(model.out, {
+                model.input: batch_imgs,
+                model.is_training: False
+            })
+            if member_probas is not None:
+                member_probas[rows] = batch_probas
+            if one_hot:
+                batch_probas = get_pred_from_probas_threshold(batch_probas)
+            total[rows] += batch_probas
+        start = rows.stop
+        print('Processed {} out of {} imgs'.format(start, testIterator.n))
+    for sess, _, member_probas, key, description in members:
+        sess.close()
+        if member_probas is not None:
+            cache.save(key, member_probas, description)
+    return testIterator, total / len(config_array)
+
+
+def predict_each(config_array, check_array, one_hot, cache=None):
+    """
+    Mean predictions of several models on the test set, predicting with
+    one model after the other (see predict_single_pass for the arguments).
+    """
+    # not needed just to question n
+    testIterator = DataTestLoader(config_array[0])
+    probas = np.zeros((len(config_array), testIterator.n, 28))
+    i = 0
+    for config, check in zip(config_array, check_array):
+        # create tensorflow session
+        sess = tf.Session()
+        # create your data generator
+        # here config file used for init does not matter
+        testIterator = DataTestLoader(config)
+        key = member_probas = None
+        if cache is not None:
+            key = cache.key(config, check, 'test', testIterator.image_ids)
+            member_probas = cache.load(key)
+        if member_probas is None:
+            # create an instance of the model you want
+            try:
+                ModelInit = all_models[config.model]
+                model = ModelInit(config)
+            except AttributeError:
+                print("The model to use is not specified in the config file")
+                exit(1)
+
+            # load model if exists
+            model.load(sess, check)
+            # here you predict from your model
+            predictor = Predictor(sess, model, config)
+            member_probas = predictor.predict_probas(testIterator,
+                                                     one_hot=False)
+            print('processed {} model'.format(model))
+            if cache is not None:
+                cache.save(key, member_probas,
+                           member_description(config, check))
+        else:
+            print('Loaded the cached probabilities of {}'.format(
+                config.exp_name))
+        if one_hot:
+            member_probas = get_pred_from_probas_threshold(member_probas)
+        probas[i, :, :] = member_probas
+        i += 1
+        sess.close()
+        tf.reset_default_graph()
+    return testIterator, np.mean(probas, axis=0)
 
 
 def main():
@@ -31,45 +176,28 @@ def main():
         print("missing or invalid arguments")
         raise
 
-    # not needed just to question n
-    testIterator = DataTestLoader(config_array[0])
-    probas = np.zeros((len(config_array), testIterator.n, 28))
-    i = 0
-    for config, check in zip(config_array, check_array):
-        # create tensorflow session
-        sess = tf.Session()
-        # create your data generator
-        # here config file used for init does not matter
-        testIterator = DataTestLoader(config)
-        # create an instance of the model you want
-        try:
-            ModelInit = all_models[config.model]
-            model = ModelInit(config)
-        except AttributeError:
-            print("The model to use is not specified in the config file")
-            exit(1)
-
-        # load model if exists
-        model.load(sess, check)
-        # here you predict from your model
-        predictor = Predictor(sess, model, config)
-        probas[i, :, :] = predictor.predict_probas(testIterator)
-        print('processed {} model'.format(model))
-        i += 1
-        tf.reset_default_graph()
-    probas = np.mean(probas, axis=0)
+    # with per-class thresholds (chosen on the mean probabilities, see
+    # optimize_thresholds_main.py) the probabilities are averaged,
+    # otherwise the predictions
+    one_hot = args.thresholds is None
+    cache = None
+    if args.proba_cache is not None:
+        cache = ProbaCache(dtype=args.proba_cache)
+    if args.single_pass:
+        testIterator, probas = predict_single_pass(
+            config_array, check_array, one_hot, cache)
+    else:
+        testIterator, probas = predict_each(
+            config_array, check_array, one_hot, cache)
     print(np.shape(probas))
-    one_hot_pred = get_pred_from_probas_threshold(probas)
-    bin = MultiLabelBinarizer(classes=np.arange(28))
-    bin.fit([[1]])  # needed for instantiation of the object
-    pred = bin.inverse_transform(one_hot_pred)
-    predicted_labels = [
-        ' '.join([str(p) for p in sample_pred]) for sample_pred in pred
-    ]
-    print(np.shape(predicted_labels))
-    testIterator.result['Predicted'] = predicted_labels
-    testIterator.result = testIterator.result.sort_values(by='Id')
-    testIterator.result.to_csv(outfile, index=False)
+    if args.thresholds is None:
+        one_hot_pred = get_pred_from_probas_threshold(probas)
+    else:
+        one_hot_pred = get_pred_from_probas_threshold(
+            probas, load_thresholds(args.thresholds))
+    writer = SubmissionWriter(outfile, testIterator.image_ids)
+    writer.write(one_hot_pred)
+    writer.close()
 
 
 if __name__ == '__main__':
@@ -37,8 +37,8 @@ def main():
     # load model if exists
     model.load(sess, args.checkpoint_nb)
     # here you predict from your model
-    predictor = Predictor(sess, model, config)
-    predictor.predict(testIterator)
+    predictor = Predictor(sess, model, config, args.thresholds)
+    predictor.predict(testIterator, args.resume)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+import copy
+import tensorflow as tf
+
+from data_loader.data_generator import DataGenerator
+from models.models import all_models
+from trainers.Network_trainer import NetworkTrainer
+from trainers.multi_trainer import MultiNetworkTrainer
+from utils.config import process_config
+from utils.dirs import create_dirs
+from utils.logger import Logger
+from utils.utils import get_args
+
+# config entries that define the data, they must be the same for all models
+DATA_KEYS = ['batch_size', 'val_split', 'augment', 'virtual_augment',
+             'validate_augmented', 'packed', 'input_size',
+             'resize_interpolation']
+
+
+def main():
+    """
+    Trains the models of several config files (e.g. the bagging_resnet
+    configs, that only differ by their random_state) in one process, on
+    one stream of batches (see MultiNetworkTrainer).
+    """
+    try:
+        args = get_args()
+        config_array = [process_config(x) for x in args.config.split(" ")]
+    except Exception:
+        print("missing or invalid arguments")
+        raise
+    for key in DATA_KEYS:
+        values = set(str(getattr(config, key, None))
+                     for config in config_array)
+        if len(values) > 1:
+            print("All configs must have the same {} to share "
+                  "their data (got {})".format(key, values))
+            exit(1)
+
+    # the shared loader serves the whole training set, the bootstrap
+    # samples are given to the models as example weights
+    data_config = copy.copy(config_array[0])
+    data_config.pop('bootstrap_size', None)
+    data = DataGenerator(data_config)
+
+    trainers = []
+    for config in config_array:
+        if getattr(config, 'input_pipeline', 'feed_dict') != 'feed_dict':
+            print('WARN: {} - the models are fed by the shared loader, '
+                  'using input_pipeline feed_dict'.format(config.exp_name))
+        config.input_pipeline = 'feed_dict'
+        config.image_size = data_config.image_size
+        # create the experiments dirs
+        create_dirs([config.summary_dir, config.checkpoint_dir])
+        # every model has its own graph and session
+        graph = tf.Graph()
+        with graph.as_default():
+            configSess = tf.ConfigProto(
+                allow_soft_placement=True, log_device_placement=False)
+            configSess.gpu_options.allow_growth = True
+            sess = tf.Session(config=configSess, graph=graph)
+            # create an instance of the model you want
+            try:
+                ModelInit = all_models[config.model]
+                model = ModelInit(config)
+            except AttributeError:
+                raise
+            # create tensorboard logger
+            logger = Logger(sess, config)
+            trainer = NetworkTrainer(sess, model, data, config, logger)
+            # load model if exists
+            model.load(sess)
+        trainers.append(trainer)
+
+    MultiNetworkTrainer(data, trainers).train()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,32 @@
-from models.DeepYeast_model import DeepYeastModel
-from models.DeepLoc_model import DeepLocModel
-from models.CP4_model import CP4Model
-from models.CBDP4_model import CBDP4Model
-from models.resNet_model import ResNetModel
-from models.densenet_model import DenseNetModel
-
-all_models = {
-    "DeepYeast": DeepYeastModel,
-    "DeepLoc": DeepLocModel,
-    "CP4": CP4Model,
-    "CBDP4": CBDP4Model,
-    "ResNet": ResNetModel,
-    "DenseNet": DenseNetModel,
+import importlib
+from collections.abc import Mapping
+
+# name in the config -> (module, class) of the model
+MODELS = {
+    "DeepYeast": ("models.DeepYeast_model", "DeepYeastModel"),
+    "DeepLoc": ("models.DeepLoc_model", "DeepLocModel"),
+    "CP4": ("models.CP4_model", "CP4Model"),
+    "CBDP4": ("models.CBDP4_model", "CBDP4Model"),
+    "ResNet": ("models.resNet_model", "ResNetModel"),
+    "DenseNet": ("models.densenet_model", "DenseNetModel"),
 }
+
+
+class LazyModels(Mapping):
+    """
+    Registry of the models: all_models[config.model] imports only the
+    module of the requested model (and TensorFlow) when it is looked up.
+    """
+
+    def __getitem__(self, name):
+        module, model = MODELS[name]
+        return getattr(importlib.import_module(module), model)
+
+    def __iter__(self):
+        return iter(MODELS)
+
+    def __len__(self):
+        return len(MODELS)
+
+
+all_models = LazyModels()
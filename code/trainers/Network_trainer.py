@@ -1,8 +1,9 @@
+import os
+import tensorflow as tf
 from base.base_train import BaseTrain
 from tqdm import tqdm
-import numpy as np
-from sklearn.metrics import f1_score
-from utils.predictor import get_pred_from_probas
+from utils.metrics import MetricsAccumulator, macro_f1
+from utils.profiler import save_trace
 
 
 class NetworkTrainer(BaseTrain):
@@ -14,64 +15,90 @@ class NetworkTrainer(BaseTrain):
         except AttributeError:
             print('WARN: use_weighted_loss not set - using False')
             self.config.use_weighted_loss = False
+        if not hasattr(self.config, 'in_graph_metrics'):
+            self.config.in_graph_metrics = False
+        # run every trace_every-th step with full tracing (0: never)
+        if not hasattr(self.config, 'trace_every'):
+            self.config.trace_every = 0
+        # class weights of the loss (see MultiNetworkTrainer for models
+        # trained on a bootstrap sample of the data given as weights)
+        self.class_weights = self.data.class_weights
+        # probabilities and labels of the epoch, filled in place
+        self.train_metrics = MetricsAccumulator(
+            self.data.train_batches_per_epoch * self.config.batch_size)
+        self.val_metrics = MetricsAccumulator(
+            self.data.val_batches_per_epoch * self.config.batch_size)
 
     def train_epoch(self):
-        self.data.set_batch_iterator(type='train')
+        if self.model.pipeline is None:
+            # with the example weights of a weighted bootstrap
+            self.data.set_batch_iterator(
+                type='train',
+                with_weights=self.data.example_weights is not None)
+        else:
+            self.model.pipeline.start(self.sess, self.data, 'train')
+        self.start_epoch()
         loop = tqdm(range(self.data.train_batches_per_epoch))
-        losses = []
-        train_probas = []
-        train_true = []
         for _ in loop:
             loss, pred, true_label = self.train_step()
-            losses.append(loss)
-            train_probas = np.append(train_probas, pred)
-            train_true = np.append(train_true, true_label)
-            cur_it = self.model.global_step_tensor.eval(self.sess)
-            print(loss)
-            if cur_it % (self.data.train_batches_per_epoch // 5) == 0:
-                print(train_true[0:28])
-                print(train_probas[0:28])
-                print(loss)
-                # Save the training values every 10 steps
-                train_loss = np.mean(losses)
-                train_true = np.reshape(train_true, (-1, 28))
-                train_probas = np.reshape(train_probas, (-1, 28))
-                train_f1 = f1_score(
-                    train_true,
-                    get_pred_from_probas(train_probas),
-                    average='macro')
-                train_f1_2 = f1_score(
-                    train_true,
-                    np.greater(train_probas, 0.05),
-                    average='macro')
-                train_f1_3 = f1_score(
-                    train_true, np.greater(train_probas, 0.1), average='macro')
-                train_f1_4 = f1_score(
-                    train_true, np.greater(train_probas, 0.2), average='macro')
-                losses = []
-                train_probas = []
-                train_true = []
-                print('Step {}: training_loss:{}, f1:{}'
-                      ', f1_005:{}, f1_01:{}, f1_02:{}'.format(
-                          cur_it, train_loss, train_f1, train_f1_2, train_f1_3,
-                          train_f1_4))
-                train_summaries_dict = {
-                    'loss': train_loss,
-                    'f1': train_f1,
-                    'f1_005_thres': train_f1_2,
-                    'f1_01_thres': train_f1_3,
-                    'f1_02_thres': train_f1_4,
-                }
+            self.log_step(loss, pred, true_label)
+        # Stop the loader (and its prefetching threads) of this epoch
+        if self.model.pipeline is None:
+            self.data.train_iterator.close()
+        with self.profiler.phase('validation'):
+            val_results = self.val_step()
+        self.end_epoch(val_results)
+
+    def start_epoch(self):
+        """ Resets the training values summarized during an epoch """
+        self.train_metrics.reset()
+        self.profiler.start_epoch()
+        # counted by train_step afterwards, rather than read every step
+        self.cur_it = self.model.global_step_tensor.eval(self.sess)
+
+    def log_step(self, loss, pred, true_label):
+        """
+        Keeps the values of one training step and summarizes them
+        5 times per epoch.
+        """
+        with self.profiler.phase('metrics'):
+            self.train_metrics.add(pred, true_label, loss)
+        if self.cur_it % (self.data.train_batches_per_epoch // 5) == 0:
+            # Save the training values every 10 steps
+            with self.profiler.phase('metrics'):
+                train_loss, train_f1, train_f1_2, train_f1_3, train_f1_4 = \
+                    self.train_metrics.results()
+                self.train_metrics.reset()
+            print('Step {}: training_loss:{}, f1:{}'
+                  ', f1_005:{}, f1_01:{}, f1_02:{}'.format(
+                      self.cur_it, train_loss, train_f1, train_f1_2,
+                      train_f1_3, train_f1_4))
+            train_summaries_dict = {
+                'loss': train_loss,
+                'f1': train_f1,
+                'f1_005_thres': train_f1_2,
+                'f1_01_thres': train_f1_3,
+                'f1_02_thres': train_f1_4,
+            }
+            with self.profiler.phase('summaries'):
                 self.logger.summarize(
-                    cur_it, summaries_dict=train_summaries_dict)
+                    self.cur_it, summaries_dict=train_summaries_dict)
+
+    def end_epoch(self, val_results):
+        """
+        Saves the model and summarizes the validation results
+        (see val_step) at the end of every epoch.
+        """
         # Saving every epoch
-        self.model.save(self.sess)
+        with self.profiler.phase('save'):
+            self.model.save(self.sess)
         # Evaluate on validation at the end of every epoch
         val_loss, val_f1, \
-            val_f1_2, val_f1_3, val_f1_4 = self.val_step()
+            val_f1_2, val_f1_3, val_f1_4 = val_results
         print('Step {}: val_loss:{}, val_f1:{},'
               ' val_f1_005:{}, val_f1_01:{}, val_f1_02:{} '.format(
-                  cur_it, val_loss, val_f1, val_f1_2, val_f1_3, val_f1_4))
+                  self.cur_it, val_loss, val_f1, val_f1_2, val_f1_3,
+                  val_f1_4))
         val_summaries_dict = {
             'loss': val_loss,
             'f1': val_f1,
@@ -79,49 +106,112 @@ class NetworkTrainer(BaseTrain):
             'f1_01_thres': val_f1_3,
             'f1_02_thres': val_f1_4
         }
-        self.logger.summarize(
-            cur_it, summaries_dict=val_summaries_dict, summarizer='test')
+        with self.profiler.phase('summaries'):
+            self.logger.summarize(
+                self.cur_it, summaries_dict=val_summaries_dict,
+                summarizer='test')
+        self.profiler.end_epoch(self.logger, self.cur_it)
 
-    def train_step(self):
-        batch_x, batch_y = next(self.data.train_iterator)
-        print(np.shape(batch_y))
+    def train_step(self, batch=None):
+        """
+        Runs one training step, on the next batch of the model's loader or
+        on the given batch, (batch_x, batch_y) or
+        (batch_x, batch_y, example_weights).
+        """
         feed_dict = {
-            self.model.input: batch_x,
-            self.model.label: batch_y,
             self.model.is_training: True,
-            self.model.class_weights: self.data.class_weights
+            self.model.class_weights: self.class_weights
         }
-        _, loss, out = self.sess.run(
-            [self.model.train_step, self.model.loss, self.model.out],
-            feed_dict=feed_dict)
+        if batch is None and self.model.pipeline is None:
+            with self.profiler.phase('loader'):
+                batch = next(self.data.train_iterator)
+        if batch is not None:
+            feed_dict[self.model.input] = batch[0]
+            feed_dict[self.model.label] = batch[1]
+            if len(batch) > 2:
+                feed_dict[self.model.example_weights] = batch[2]
+        options = run_metadata = None
+        if self.config.trace_every and \
+                (self.cur_it + 1) % self.config.trace_every == 0:
+            options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+            run_metadata = tf.RunMetadata()
+        with self.profiler.phase('run'):
+            _, loss, out, batch_y = self.sess.run(
+                [self.model.train_step, self.model.loss, self.model.out,
+                 self.model.label],
+                feed_dict=feed_dict, options=options,
+                run_metadata=run_metadata)
+        # every step increments the global step
+        self.cur_it += 1
+        if run_metadata is not None:
+            with self.profiler.phase('trace'):
+                save_trace(run_metadata,
+                           os.path.join(self.config.summary_dir, 'traces'),
+                           self.cur_it)
+                self.logger.train_summary_writer.add_run_metadata(
+                    run_metadata, 'step{}'.format(self.cur_it), self.cur_it)
+        self.profiler.step()
         return loss, out, batch_y
 
+    def val_feed_dict(self, batch_x=None, batch_y=None):
+        """ feed_dict of one validation batch """
+        feed_dict = {
+            self.model.is_training: False,
+            self.model.class_weights: self.class_weights
+        }
+        if batch_x is not None:
+            feed_dict[self.model.input] = batch_x
+            feed_dict[self.model.label] = batch_y
+        return feed_dict
+
+    def val_batches(self):
+        """
+        Generates the feed_dict of every validation batch, either with
+        the images of the DataGenerator or (tf.data pipeline) without.
+        """
+        if self.model.pipeline is None:
+            for batch_x, batch_y in self.data.batch_iterator(type='val'):
+                yield self.val_feed_dict(batch_x, batch_y)
+        else:
+            self.model.pipeline.start(self.sess, self.data, 'val')
+            for _ in range(self.data.val_batches_per_epoch):
+                yield self.val_feed_dict()
+
+    def val_batch(self, feed_dict):
+        """ Loss, probabilities and labels of one validation batch """
+        return self.sess.run(
+            [self.model.loss, self.model.out, self.model.label],
+            feed_dict=feed_dict)
+
+    def start_val(self):
+        """ Resets the validation metrics """
+        if self.config.in_graph_metrics:
+            self.sess.run(self.model.reset_metrics)
+        else:
+            self.val_metrics.reset()
+
+    def add_val_batch(self, feed_dict):
+        """ Evaluates one validation batch and accumulates its results """
+        if self.config.in_graph_metrics:
+            # only the counts of the model's local variables are updated
+            self.sess.run(self.model.update_metrics, feed_dict=feed_dict)
+        else:
+            loss, out, batch_y = self.val_batch(feed_dict)
+            self.val_metrics.add(out, batch_y, loss)
+
+    def val_results(self):
+        """
+        Validation loss and f1 scores (loss, f1, f1_005, f1_01, f1_02)
+        of the batches added since start_val.
+        """
+        if self.config.in_graph_metrics:
+            counts, (loss_sum, num_batches) = self.sess.run(
+                [self.model.metric_counts, self.model.metric_loss])
+            return tuple([loss_sum / num_batches] + list(macro_f1(*counts)))
+        return self.val_metrics.results()
+
     def val_step(self):
-        val_iterator = self.data.batch_iterator(type='val')
-        val_losses = []
-        val_probas = []
-        val_true = []
-        for batch_x, batch_y in val_iterator:
-            feed_dict = {
-                self.model.input: batch_x,
-                self.model.label: batch_y,
-                self.model.is_training: False,
-                self.model.class_weights: self.data.class_weights
-            }
-            loss, out = self.sess.run([self.model.loss, self.model.out],
-                                      feed_dict=feed_dict)
-            val_losses.append(loss)
-            val_probas = np.append(val_probas, out)
-            val_true = np.append(val_true, batch_y)
-        val_true = np.reshape(val_true, (-1, 28))
-        val_probas = np.reshape(val_probas, (-1, 28))
-        val_preds = get_pred_from_probas(val_probas)
-        val_f1 = f1_score(val_true, val_preds, average='macro')
-        val_f1_2 = f1_score(
-            val_true, np.greater(val_probas, 0.05), average='macro')
-        val_f1_3 = f1_score(
-            val_true, np.greater(val_probas, 0.1), average='macro')
-        val_f1_4 = f1_score(
-            val_true, np.greater(val_probas, 0.2), average='macro')
-        val_loss = np.mean(val_losses)
-        return val_loss, val_f1, val_f1_2, val_f1_3, val_f1_4
+        self.start_val()
+        for feed_dict in self.val_batches():
+            self.add_val_batch(feed_dict)
+        return self.val_results()
@@ -0,0 +1,78 @@
+from tqdm import tqdm
+
+
+class MultiNetworkTrainer:
+    """
+    Trains several models side by side on one stream of batches (e.g. the
+    bagged ResNets of configs/final_exp/bagging_resnet, which only differ
+    by their bootstrap sample): each batch is loaded once by the shared
+    DataGenerator and fed to every model.
+
+    Each model is trained by its own NetworkTrainer (own graph and
+    session, checkpoints and summaries). The shared DataGenerator serves
+    the whole training set; the bootstrap sample of a model (its
+    bootstrap_size and random_state) is given to its loss as example
+    weights, the multiplicity of every image in the sample.
+    """
+
+    def __init__(self, data, trainers):
+        """
+        Args:
+            data: the shared DataGenerator (without bootstrap_size)
+            trainers: a NetworkTrainer per model, built on data
+        """
+        self.data = data
+        self.trainers = trainers
+        for trainer in trainers:
+            if hasattr(trainer.config, 'bootstrap_size'):
+                bootstrap_size = trainer.config.bootstrap_size
+            else:
+                bootstrap_size = None
+            if hasattr(trainer.config, 'random_state'):
+                random_state = trainer.config.random_state
+            else:
+                random_state = 42
+            if hasattr(trainer.config, 'bootstrap_mode'):
+                mode = trainer.config.bootstrap_mode
+            else:
+                mode = 'resample'
+            trainer.example_weights = data.bootstrap_weights(
+                bootstrap_size, random_state, mode)
+            # class weights of the bootstrap sample
+            trainer.class_weights = data.weighted_class_weights(
+                trainer.example_weights)
+
+    def train(self):
+        while True:
+            # models resumed from a checkpoint can be at different epochs
+            active = [trainer for trainer in self.trainers
+                      if trainer.model.cur_epoch_tensor.eval(trainer.sess)
+                      < trainer.config.num_epochs]
+            if not active:
+                break
+            self.train_epoch(active)
+            for trainer in active:
+                trainer.sess.run(trainer.model.increment_cur_epoch_tensor)
+
+    def train_epoch(self, trainers):
+        for trainer in trainers:
+            trainer.start_epoch()
+        batches = self.data.batch_iterator(type='train', with_rows=True)
+        for batch_x, batch_y, rows in tqdm(
+                batches, total=self.data.train_batches_per_epoch):
+            for trainer in trainers:
+                trainer.log_step(*trainer.train_step(
+                    (batch_x, batch_y, trainer.example_weights[rows])))
+
+        # Evaluate all models on each validation batch
+        for trainer in trainers:
+            trainer.start_val()
+        for batch_x, batch_y in self.data.batch_iterator(type='val'):
+            for trainer in trainers:
+                with trainer.profiler.phase('validation'):
+                    trainer.add_val_batch(
+                        trainer.val_feed_dict(batch_x, batch_y))
+        for trainer in trainers:
+            with trainer.profiler.phase('validation'):
+                val_results = trainer.val_results()
+            trainer.end_epoch(val_results)
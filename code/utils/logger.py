@@ -30,7 +30,9 @@ class Logger:
             summary_writer = self.train_summary_writer
         else:
             summary_writer = self.test_summary_writer
-        with tf.variable_scope(scope):
+        # the summary ops are added to the graph of the session (models
+        # trained side by side each have their own graph)
+        with self.sess.graph.as_default(), tf.variable_scope(scope):
 
             if summaries_dict is not None:
                 summary_list = []
@@ -1,12 +1,13 @@
 import tensorflow as tf
 
 
-def f1_loss(y_true, y_pred):
+def f1_loss(y_true, y_pred, weights=1.0):
     # y_pred should be the proba to make it differentiable
-    tp = tf.reduce_sum(tf.cast(y_true*y_pred, 'float'), axis=0)
+    # weights: optional weight [batch_size, 1] of every example
+    tp = tf.reduce_sum(tf.cast(y_true*y_pred*weights, 'float'), axis=0)
     # tn = tf.reduce_sum(tf.cast((1-y_true)*(1-y_pred), 'float'), axis=0)
-    fp = tf.reduce_sum(tf.cast((1-y_true)*y_pred, 'float'), axis=0)
-    fn = tf.reduce_sum(tf.cast(y_true*(1-y_pred), 'float'), axis=0)
+    fp = tf.reduce_sum(tf.cast((1-y_true)*y_pred*weights, 'float'), axis=0)
+    fn = tf.reduce_sum(tf.cast(y_true*(1-y_pred)*weights, 'float'), axis=0)
 
     p = tp / (tp + fp + tf.keras.backend.epsilon())
     r = tp / (tp + fn + tf.keras.backend.epsilon())
@@ -16,7 +17,7 @@ def f1_loss(y_true, y_pred):
     return 1 - tf.reduce_mean(f1)
 
 
-def binary_focal_loss(y_true, y_pred, gamma=2.0, alpha=0.25):
+def binary_focal_loss(y_true, y_pred, gamma=2.0, alpha=0.25, weights=1.0):
     """
     Based on https://www.kaggle.com/achoetwice/focal-loss-with-pre-train-v2
     with modifications from Keras to TF
@@ -35,6 +36,8 @@ def binary_focal_loss(y_true, y_pred, gamma=2.0, alpha=0.25):
     Parameters:
         alpha -- the same as wighting factor in balanced cross entropy
         gamma -- focusing parameter for modulating factor (1-p)
+        weights -- weight [batch_size, 1] of every example (e.g. bootstrap
+            multiplicities)
     Default value:
         gamma -- 2.0 as mentioned in the paper
         alpha -- 0.25 as mentioned in the paper
@@ -57,7 +60,7 @@ def binary_focal_loss(y_true, y_pred, gamma=2.0, alpha=0.25):
     weight = alpha_t * tf.pow((1-p_t), gamma)
     # Calculate focal loss
     loss = weight * cross_entropy
-    # Sum the losses in mini_batch
-    loss = tf.reduce_sum(loss)
+    # Sum the (weighted) losses in mini_batch
+    loss = tf.reduce_sum(loss * weights)
 
     return loss
@@ -0,0 +1,240 @@
+import numpy as np
+
+# thresholds of the f1 scores summarized besides the one of
+# get_pred_from_probas
+F1_THRESHOLDS = [0.05, 0.1, 0.2]
+
+
+def threshold_counts(labels, probas, thresholds):
+    """
+    Per class TP/FP/FN counts of the predictions probas > threshold, for
+    every threshold, in one pass: the scores of each class are sorted once
+    and the thresholds are located with a binary search.
+
+    Args:
+        labels: [n, C] one-hot labels
+        probas: [n, C] probabilities
+        thresholds: T thresholds
+
+    Returns the int64 [T, C] arrays tp, fp, fn
+    """
+    labels = np.asarray(labels) > 0
+    # compared in float64 (the precision of the former np.append buffers)
+    probas = np.asarray(probas, dtype=np.float64)
+    thresholds = np.asarray(thresholds, dtype=np.float64).reshape(-1)
+    n, num_classes = probas.shape
+    order = np.argsort(probas, axis=0, kind='stable')
+    sorted_probas = np.take_along_axis(probas, order, axis=0)
+    # positives among the i smallest scores of each class
+    cum_pos = np.zeros((n + 1, num_classes), dtype=np.int64)
+    np.cumsum(np.take_along_axis(labels, order, axis=0), axis=0,
+              out=cum_pos[1:])
+    positives = cum_pos[-1]
+    tp = np.empty((len(thresholds), num_classes), dtype=np.int64)
+    predicted = np.empty_like(tp)
+    for c in range(num_classes):
+        # number of scores <= threshold
+        below = np.searchsorted(sorted_probas[:, c], thresholds, side='right')
+        tp[:, c] = positives[c] - cum_pos[below, c]
+        predicted[:, c] = n - below
+    return tp, predicted - tp, positives[None, :] - tp
+
+
+def decision_rule(probas, threshold=0.5, max_labels=None):
+    """
+    Batched decision rule: the classes with probas > threshold, at least
+    the most probable class of every row and, if max_labels is given, at
+    most its max_labels most probable predicted classes.
+    Ties are broken as the former row by row rule: the most probable class
+    is the first one (np.argmax) and the max_labels kept are the last ones
+    of the stable ascending order (the highest classes of equal probas).
+
+    Args:
+        probas: [n, 28] probabilities
+        threshold: a threshold or a vector of 28 per-class thresholds
+        max_labels: maximum number of classes of a row (None for no limit)
+
+    Returns the bool [n, 28] predictions
+    """
+    probas = np.asarray(probas)
+    pred = np.greater(probas, threshold)
+    # if no classes predicted choose the most probable one
+    empty = np.flatnonzero(~pred.any(axis=1))
+    pred[empty, np.argmax(probas[empty], axis=1)] = True
+    if max_labels is not None:
+        over = np.flatnonzero(pred.sum(axis=1) > max_labels)
+        if len(over):
+            # keep the max_labels most probable of the predicted classes
+            scores = np.where(pred[over], probas[over], -np.inf)
+            top = np.argsort(scores, axis=1, kind='stable')[:, -max_labels:]
+            pred[over] = False
+            pred[over[:, None], top] = True
+    return pred
+
+
+def rule_counts(labels, probas, thresholds, max_labels=4):
+    """
+    Per class TP/FP/FN counts of the decision rule of get_pred_from_probas
+    (see decision_rule) for every threshold: the labels with
+    probas > threshold, at least the most probable one and at most the
+    max_labels most probable ones.
+
+    Args:
+        labels: [n, C] one-hot labels
+        probas: [n, C] probabilities
+        thresholds: T thresholds
+        max_labels: maximum number of labels of an image (None for no
+            limit, the rule of get_pred_from_probas_threshold)
+
+    Returns the int64 [T, C] arrays tp, fp, fn
+    """
+    # compared in float64 (the precision of the former np.append buffers)
+    probas = np.asarray(probas, dtype=np.float64)
+    counts = [prediction_counts(labels, decision_rule(probas, t, max_labels))
+              for t in np.asarray(thresholds, dtype=np.float64).reshape(-1)]
+    return tuple(np.array([c[i] for c in counts], dtype=np.int64)
+                 for i in range(3))
+
+
+def macro_f1(tp, fp, fn):
+    """
+    Macro f1 scores from [T, C] counts (the f1 of a class without true
+    or predicted positives is 0, as in sklearn).
+
+    Returns a float64 array of T scores
+    """
+    tp = np.asarray(tp, dtype=np.float64)
+    denominator = 2 * tp + fp + fn
+    f1 = np.divide(2 * tp, denominator, out=np.zeros_like(tp),
+                   where=denominator > 0)
+    return f1.mean(axis=-1)
+
+
+def prediction_counts(labels, preds):
+    """ Per class TP/FP/FN counts [C] of one-hot predictions """
+    labels = np.asarray(labels) > 0
+    preds = np.asarray(preds) > 0
+    tp = (preds & labels).sum(axis=0)
+    return tp, preds.sum(axis=0) - tp, labels.sum(axis=0) - tp
+
+
+def best_class_thresholds(labels, probas):
+    """
+    Per class thresholds maximizing the f1 score of probas > threshold of
+    each class (and so the macro f1), from the cumulative counts of the
+    sorted scores: O(n log n) per class.
+
+    Args:
+        labels: [n, C] one-hot labels (e.g. of the validation set)
+        probas: [n, C] probabilities (of a model or averaged over models)
+
+    Returns the float64 arrays of the C thresholds and of their f1 scores
+    (a class without positive gets the threshold 1, nothing predicted)
+    """
+    # one contiguous row per class
+    labels = np.ascontiguousarray((np.asarray(labels) > 0).T)
+    probas = np.ascontiguousarray(np.asarray(probas).T)
+    num_classes, n = labels.shape
+    thresholds = np.ones(num_classes)
+    best_f1 = np.zeros(num_classes)
+    for c in range(num_classes):
+        if n == 0 or not labels[c].any():
+            continue
+        # highest scores first (the order of ties does not matter, a
+        # threshold can not split them)
+        order = np.argsort(probas[c])[::-1]
+        sorted_scores = probas[c][order].astype(np.float64)
+        # predicting the k + 1 highest scores: tp and f1 = 2tp / (P + k + 1)
+        tp = np.cumsum(labels[c][order])
+        f1 = 2 * tp / (tp[-1] + np.arange(1, n + 1))
+        # a threshold can only split between two different scores
+        f1[:-1][sorted_scores[:-1] == sorted_scores[1:]] = -1
+        k = np.argmax(f1)
+        best_f1[c] = f1[k]
+        if k + 1 < n:
+            thresholds[c] = (sorted_scores[k] + sorted_scores[k + 1]) / 2
+        else:
+            thresholds[c] = np.nextafter(sorted_scores[k], -np.inf)
+    return thresholds, best_f1
+
+
+class MetricsAccumulator:
+    """
+    Accumulates the probabilities, labels and losses of the batches of an
+    epoch into preallocated float32/uint8 [capacity, 28] buffers, filled in
+    place (the buffers grow if more samples than expected are added).
+    """
+
+    def __init__(self, capacity, num_classes=28):
+        """
+        Args:
+            capacity: expected number of samples, e.g.
+                batches_per_epoch * batch_size
+            num_classes: number of classes
+        """
+        capacity = max(int(capacity), 1)
+        self._probas = np.empty((capacity, num_classes), dtype=np.float32)
+        self._labels = np.empty((capacity, num_classes), dtype=np.uint8)
+        self.reset()
+
+    def reset(self):
+        """ Forgets the accumulated values (the buffers are kept) """
+        self.n = 0
+        self.losses = []
+
+    def __len__(self):
+        return self.n
+
+    def _reserve(self, n):
+        if n > len(self._probas):
+            capacity = max(n, 2 * len(self._probas))
+            for name in ['_probas', '_labels']:
+                old = getattr(self, name)
+                new = np.empty((capacity, old.shape[1]), dtype=old.dtype)
+                new[:self.n] = old[:self.n]
+                setattr(self, name, new)
+
+    def add(self, probas, labels=None, loss=None):
+        """
+        Adds the values of one batch.
+
+        Args:
+            probas: [batch_size, 28] probabilities (or predictions)
+            labels: [batch_size, 28] one-hot labels
+            loss: loss of the batch
+        """
+        k = len(probas)
+        self._reserve(self.n + k)
+        self._probas[self.n:self.n + k] = probas
+        if labels is not None:
+            self._labels[self.n:self.n + k] = labels
+        if loss is not None:
+            self.losses.append(loss)
+        self.n += k
+
+    @property
+    def probas(self):
+        """ [n, 28] view of the accumulated probabilities """
+        return self._probas[:self.n]
+
+    @property
+    def labels(self):
+        """ [n, 28] view of the accumulated labels """
+        return self._labels[:self.n]
+
+    def loss(self):
+        """ Mean of the batch losses """
+        return np.mean(self.losses)
+
+    def f1_scores(self, thresholds=F1_THRESHOLDS):
+        """
+        Macro f1 scores of the predictions of get_pred_from_probas and of
+        probas > threshold for every threshold.
+        """
+        rule = macro_f1(*rule_counts(self.labels, self.probas, [0.5]))
+        return list(rule) + list(macro_f1(*threshold_counts(
+            self.labels, self.probas, thresholds)))
+
+    def results(self):
+        """ loss, f1, f1_005, f1_01, f1_02 """
+        return tuple([self.loss()] + self.f1_scores())
@@ -1,39 +1,131 @@
-from sklearn.preprocessing import MultiLabelBinarizer
+import csv
+import json
+import os
 import numpy as np
+from utils.metrics import MetricsAccumulator, decision_rule
 
 
-def get_pred_from_probas(probas):
-    tmp_pred = np.round(probas)
-    for i in range(len(probas)):
-        # if no classes predicted
-        # i.e. no probas > 0.5
-        # then choose the most probable one.
-        if np.sum(tmp_pred[i]) == 0:
-            try:
-                tmp_pred[i, np.argmax(probas[i])[0]] = 1
-            except IndexError:
-                tmp_pred[i, np.argmax(probas[i])] = 1
-        # more than 4 classes predicted take the 3 most
-        # probable ones.
-        elif np.sum(tmp_pred[i]) > 4:
-            ind = np.argsort(probas[i])[-4:]
-            tmp_pred[i] = np.zeros(28)
-            tmp_pred[i, ind] = 1
-    return(tmp_pred)
+def get_pred_from_probas(probas, threshold=0.5, max_labels=4):
+    """
+    Predictions of the probas > 0.5 (or per-class thresholds), at least
+    the most probable class and at most the 4 most probable ones,
+    as an array of the type of probas.
+    """
+    probas = np.asarray(probas)
+    return decision_rule(probas, threshold, max_labels).astype(probas.dtype)
 
 
 def get_pred_from_probas_threshold(probas, threshold=0.05):
-    tmp_pred = np.greater(probas, threshold)
-    for i in range(len(probas)):
-        # if no classes predicted
-        # i.e. no probas > 0.5
-        # then choose the most probable one.
-        if np.sum(tmp_pred[i]) == 0:
-            try:
-                tmp_pred[i, np.argmax(probas[i])[0]] = 1
-            except IndexError:
-                tmp_pred[i, np.argmax(probas[i])] = 1
-    return(tmp_pred)
+    """
+    bool predictions of the probas > threshold (a threshold or per-class
+    thresholds), at least the most probable class.
+    """
+    return decision_rule(probas, threshold)
+
+
+def save_thresholds(path, thresholds):
+    """ Saves per-class thresholds as a json vector """
+    with open(path, 'w') as f:
+        json.dump([float(t) for t in thresholds], f)
+
+
+def load_thresholds(path):
+    """ Per-class thresholds of a json vector (see save_thresholds) """
+    with open(path, 'r') as f:
+        thresholds = np.asarray(json.load(f), dtype=np.float64)
+    if thresholds.shape != (28,):
+        raise ValueError('{} does not hold 28 thresholds'.format(path))
+    return thresholds
+
+
+def labels_to_strings(one_hot):
+    """
+    Submission strings ('0 5 25', classes in ascending order) of one-hot
+    predictions [n, 28]: every row is encoded as a bitmask and the string
+    of each distinct bitmask is built once.
+    """
+    one_hot = np.asarray(one_hot) > 0
+    masks = one_hot.astype(np.int64) @ (np.int64(1) << np.arange(28))
+    unique_masks, inverse = np.unique(masks, return_inverse=True)
+    strings = np.array([
+        ' '.join(str(c) for c in range(28) if (mask >> c) & 1)
+        for mask in unique_masks], dtype=object)
+    return strings[inverse.reshape(-1)]
+
+
+class SubmissionWriter:
+    """
+    Streams the predictions of the test images, in the order of the
+    loader, to <out_file>.partial (flushed after every batch); close()
+    then writes <out_file> sorted by Id and removes the partial file.
+    With resume, the rows of an existing partial file are kept and
+    self.start is the row to predict next.
+    """
+
+    def __init__(self, out_file, image_ids, resume=False):
+        """
+        Args:
+            out_file: path of the submission csv file
+            image_ids: ids of the test images, in the order of the loader
+            resume: keep the rows of an existing partial file
+        """
+        self.out_file = out_file
+        self.partial_file = out_file + '.partial'
+        self.image_ids = image_ids
+        self.start = 0
+        if resume and os.path.isfile(self.partial_file):
+            self.start = self._flushed_rows()
+        if self.start > 0:
+            print('Resuming after {} rows'.format(self.start))
+            self.f = open(self.partial_file, 'a', newline='')
+        else:
+            self.f = open(self.partial_file, 'w', newline='')
+            self.f.write('Id,Predicted\n')
+        self.n = self.start
+        self.writer = csv.writer(self.f, lineterminator='\n')
+
+    def _flushed_rows(self):
+        """
+        Number of complete rows of the partial file (a partial last line
+        is cut), 0 if they are not the first image ids.
+        """
+        with open(self.partial_file, 'r', newline='') as f:
+            lines = f.read().split('\n')
+        # the last item is empty or an incomplete line
+        rows = [line.split(',')[0] for line in lines[1:-1]]
+        if len(rows) > len(self.image_ids) or \
+                rows != [str(i) for i in self.image_ids[:len(rows)]]:
+            print('WARN: {} does not match the test images - starting '
+                  'over'.format(self.partial_file))
+            return 0
+        with open(self.partial_file, 'r+', newline='') as f:
+            f.truncate(sum(len(line) + 1 for line in lines[:-1]))
+        return len(rows)
+
+    def write(self, one_hot):
+        """ Appends the predictions [batch_size, 28] of the next images """
+        ids = self.image_ids[self.n:self.n + len(one_hot)]
+        self.writer.writerows(zip(ids, labels_to_strings(one_hot)))
+        self.f.flush()
+        self.n += len(one_hot)
+
+    def close(self):
+        """ Writes the submission file sorted by Id """
+        self.f.close()
+        if self.n != len(self.image_ids):
+            print('WARN: {} predictions for {} test images, {} not '
+                  'written'.format(self.n, len(self.image_ids),
+                                   self.out_file))
+            return
+        with open(self.partial_file, 'r', newline='') as f:
+            rows = list(csv.reader(f))
+        tmp_file = self.out_file + '.tmp'
+        with open(tmp_file, 'w', newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(rows[0])
+            writer.writerows(sorted(rows[1:], key=lambda row: row[0]))
+        os.replace(tmp_file, self.out_file)
+        os.remove(self.partial_file)
 
 
 class Predictor:
@@ -42,7 +134,7 @@ class Predictor:
     on the test images for Kaggle.
     """
 
-    def __init__(self, sess, model, config):
+    def __init__(self, sess, model, config, thresholds=None):
         """ Init config, output file name for
         prediction.
 
@@ -50,15 +142,45 @@ class Predictor:
             sess: a tf session
             model: a loaded model (via model.load())
             config: a Bunch object
+            thresholds: path of per-class thresholds (json vector, see
+                optimize_thresholds_main.py), default: 0.05 for all
         """
         self.config = config
         self.sess = sess
         self.model = model
+        if thresholds is None:
+            self.thresholds = 0.05
+        else:
+            self.thresholds = load_thresholds(thresholds)
         # Defining the csv file name
         self.out_file = self.config.checkpoint_dir + 'prediction.csv'
         print("Writing to {}\n".format(self.out_file))
 
-    def predict_probas(self, testIterator):
+    def batch_probas(self, testIterator, start=0):
+        """ Generates the predicted probas of every test batch,
+        either feeding the images of the DataTestLoader or
+        reading them with the tf.data pipeline of the model.
+
+        Args:
+            testIterator: object of class DataTestLoader.
+            start: first test image to predict
+        """
+        if self.model.pipeline is None:
+            for batch_imgs in testIterator.batch_iterator(start):
+                yield self.sess.run(self.model.out, {
+                    self.model.input: batch_imgs,
+                    self.model.is_training: False
+                })
+        else:
+            self.model.pipeline.start(self.sess, testIterator, 'test',
+                                      start)
+            batch_size = self.config.batch_size
+            for _ in range(int((testIterator.n - start - 1) / batch_size)
+                           + 1):
+                yield self.sess.run(self.model.out,
+                                    {self.model.is_training: False})
+
+    def predict_probas(self, testIterator, one_hot=True):
         """ Uses a build model to
         predict probas on the test set,
         these one_hot are then converted as required by
@@ -66,27 +188,26 @@ class Predictor:
 
         Args:
             testIterator: object of class DataTestLoader.
+            one_hot: return the thresholded predictions rather than
+                the probabilities
         """
         counter = 1
-        probas = []
-        for batch_imgs in testIterator.batch_iterator():
+        probas = MetricsAccumulator(testIterator.n)
+        for batch_probas in self.batch_probas(testIterator):
             # if counter > 3:
             #     break
-            batch_probas = self.sess.run(self.model.out, {
-                self.model.input: batch_imgs,
-                self.model.is_training: False
-            })
             # one_hot_batch_pred = get_pred_from_probas(batch_probas)
-            one_hot_batch_pred = get_pred_from_probas_threshold(batch_probas)
-            probas = np.append(probas, one_hot_batch_pred)
+            if one_hot:
+                batch_probas = get_pred_from_probas_threshold(
+                    batch_probas, self.thresholds)
+            probas.add(batch_probas)
             if counter % 1 == 0:
                 print('Processed {} out of {} imgs'
-                      .format(len(probas)/28, testIterator.n))
+                      .format(len(probas), testIterator.n))
             counter += 1
-        probas = np.reshape(probas, (-1, 28))
-        return probas
+        return probas.probas
 
-    def predict(self, testIterator):
+    def predict(self, testIterator, resume=False):
         """ Uses a build model to
         predict one_hot_labels on the test set,
         these one_hot are then converted as required by
@@ -94,36 +215,18 @@ class Predictor:
 
         Args:
             testIterator: object of class DataTestLoader.
+            resume: continue an interrupted prediction from the
+                last row written (see SubmissionWriter)
         """
-        bin = MultiLabelBinarizer(classes=np.arange(28))
-        bin.fit([[1]])  # needed for instantiation of the object
-        predicted_labels = []
-        # counter just for testing purpose
-        # to stop the output after xxx predictions
-        counter = 1
-        for batch_imgs in testIterator.batch_iterator():
-            # if counter > 3:
-            #     break
-            batch_probas = self.sess.run(self.model.out, {
-                self.model.input: batch_imgs,
-                self.model.is_training: False
-            })
-            # print(batch_probas[0])
-            # one_hot_batch_pred = get_pred_from_probas(batch_probas)
-            one_hot_batch_pred = get_pred_from_probas_threshold(batch_probas)
-            # print(one_hot_batch_pred[0])
-            batch_pred = bin.inverse_transform(one_hot_batch_pred)
-            # print(batch_pred[0])
-            predicted_labels = np.append(predicted_labels, [
-                ' '.join([str(p) for p in sample_pred])
-                for sample_pred in batch_pred
-            ])
-            if counter % 1 == 0:
+        writer = SubmissionWriter(self.out_file, testIterator.image_ids,
+                                  resume)
+        if writer.start < testIterator.n:
+            for batch_probas in self.batch_probas(testIterator,
+                                                  writer.start):
+                # one_hot_batch_pred = get_pred_from_probas(batch_probas)
+                one_hot_batch_pred = get_pred_from_probas_threshold(
+                    batch_probas, self.thresholds)
+                writer.write(one_hot_batch_pred)
                 print('Processed {} out of {} imgs'
-                      .format(len(predicted_labels), testIterator.n))
-            counter += 1
-
-        print(np.shape(predicted_labels))
-        testIterator.result['Predicted'] = predicted_labels
-        testIterator.result = testIterator.result.sort_values(by='Id')
-        testIterator.result.to_csv(self.out_file, index=False)
+                      .format(writer.n, testIterator.n))
+        writer.close()
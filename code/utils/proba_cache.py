@@ -0,0 +1,250 @@
+import argparse
+import copy
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+import numpy as np
+from data_loader.file_index import save_json
+from data_loader.packed_store import set_store_defaults
+
+# config entries that do not change the predictions of a trained model
+# (training, loading and logging settings), left out of the cache keys
+RUN_KEYS = [
+    'exp_name', 'summary_dir', 'checkpoint_dir', 'num_epochs',
+    'learning_rate', 'max_to_keep', 'batch_size', 'val_split',
+    'bootstrap_size', 'bootstrap_mode', 'random_state', 'augment',
+    'virtual_augment', 'validate_augmented', 'packed', 'use_weighted_loss',
+    'f1_loss', 'focal_loss', 'prefetch_batches', 'loader_workers',
+    'reuse_batch_buffers', 'input_pipeline', 'shuffle_buffer', 'profile',
+    'trace_every', 'in_graph_metrics']
+
+
+def cache_folder():
+    """ Default folder of the cache: EXP_PATH/proba_cache """
+    experiment_dir = os.getenv("EXP_PATH")
+    if experiment_dir is None:
+        print("Set your EXP_PATH env first")
+        sys.exit(1)
+    return os.path.join(experiment_dir, 'proba_cache')
+
+
+def checkpoint_files(config, checkpoint_nb=None):
+    """
+    Files of the checkpoint of a model (as restored by BaseModel.load),
+    an empty list if there is none.
+    """
+    if checkpoint_nb is None:
+        import tensorflow as tf
+        prefix = tf.train.latest_checkpoint(config.checkpoint_dir)
+        if prefix is None:
+            return []
+    else:
+        prefix = config.checkpoint_dir + '-{}'.format(checkpoint_nb)
+    return sorted(glob.glob(prefix + '.*'))
+
+
+class ProbaCache:
+    """
+    Content-addressed cache of the probabilities [n, 28] predicted by a
+    model on a set of images: each (checkpoint, config, split) result is
+    saved once as <key>.npy (with a <key>.json description), the key
+    being a hash of the content of the checkpoint files, of the config
+    entries that change the predictions and of the ids of the images.
+    Loading an entry refreshes its modification time, so eviction by age
+    removes the least recently used entries.
+    """
+
+    def __init__(self, folder=None, dtype='float32'):
+        """
+        Args:
+            folder: folder of the cache (default: EXP_PATH/proba_cache)
+            dtype: type of the saved probabilities ('float32' or
+                'float16', twice smaller)
+        """
+        self.folder = folder if folder is not None else cache_folder()
+        self.dtype = dtype
+        os.makedirs(self.folder, exist_ok=True)
+        # sha1 of the checkpoint files, recomputed if they change
+        self.digests_path = os.path.join(self.folder, 'file_digests.json')
+        self.digests = {}
+        if os.path.isfile(self.digests_path):
+            with open(self.digests_path, 'r') as f:
+                self.digests = json.load(f)
+
+    def file_digest(self, path):
+        """ sha1 of a file, cached by (size, modification time) """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        cached = self.digests.get(path)
+        if cached is not None and cached[:2] == signature:
+            return cached[2]
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        self.digests[path] = signature + [sha1.hexdigest()]
+        save_json(self.digests, self.digests_path)
+        return sha1.hexdigest()
+
+    def key(self, config, checkpoint_nb, split, image_ids):
+        """
+        Key of the probabilities of a model on a set of images, None if
+        the model has no checkpoint.
+
+        Args:
+            config: config of the model (after the creation of its loader,
+                which sets image_size)
+            checkpoint_nb: number of the checkpoint (None for the latest)
+            split: name of the set (e.g. 'test', 'val')
+            image_ids: ids of the images, in the order of the rows
+        """
+        files = checkpoint_files(config, checkpoint_nb)
+        if not files:
+            return None
+        # the same key whether the defaults of the loader were applied
+        # to the config or not
+        config = copy.copy(config)
+        set_store_defaults(config)
+        description = {
+            'checkpoint': [self.file_digest(path) for path in files],
+            'config': {k: v for k, v in config.items()
+                       if k not in RUN_KEYS},
+            'split': split,
+            'ids': hashlib.sha1('\n'.join(
+                str(i) for i in image_ids).encode('utf-8')).hexdigest()}
+        return hashlib.sha1(json.dumps(
+            description, sort_keys=True, default=str).encode(
+                'utf-8')).hexdigest()[:24]
+
+    def _path(self, key, extension):
+        return os.path.join(self.folder, key + extension)
+
+    def load(self, key):
+        """ Cached float32 probabilities of a key, None if not cached """
+        if key is None or not os.path.isfile(self._path(key, '.npy')):
+            return None
+        probas = np.load(self._path(key, '.npy')).astype(np.float32)
+        # last use, for eviction
+        os.utime(self._path(key, '.npy'))
+        return probas
+
+    def save(self, key, probas, description=None):
+        """
+        Saves the probabilities of a key.
+
+        Args:
+            key: key of the probabilities (see key)
+            probas: [n, 28] probabilities
+            description: dict saved with them (shown by entries)
+        """
+        if key is None:
+            return
+        tmp_path = self._path(key, '.{}.tmp.npy'.format(os.getpid()))
+        np.save(tmp_path, np.asarray(probas, dtype=self.dtype))
+        save_json(dict(description or {}, shape=list(np.shape(probas)),
+                       dtype=self.dtype), self._path(key, '.json'))
+        os.replace(tmp_path, self._path(key, '.npy'))
+
+    def cached(self, key, compute, description=None):
+        """
+        The probabilities of a key, loaded from the cache or computed by
+        compute() and saved.
+        """
+        probas = self.load(key)
+        if probas is None:
+            probas = compute()
+            self.save(key, probas, description)
+        else:
+            print('Loaded cached probabilities {}'.format(key))
+        return probas
+
+    def entries(self):
+        """
+        Entries of the cache, least recently used first: dicts with their
+        key, size (bytes), last use (timestamp) and description.
+        """
+        entries = []
+        for path in glob.glob(os.path.join(self.folder, '*.npy')):
+            key = os.path.basename(path)[:-len('.npy')]
+            if '.' in key:
+                # temporary file of an unfinished save
+                continue
+            description = {}
+            if os.path.isfile(self._path(key, '.json')):
+                with open(self._path(key, '.json'), 'r') as f:
+                    description = json.load(f)
+            stat = os.stat(path)
+            entries.append({'key': key, 'size': stat.st_size,
+                            'last_use': stat.st_mtime,
+                            'description': description})
+        return sorted(entries, key=lambda entry: entry['last_use'])
+
+    def evict(self, max_age=None, max_size=None):
+        """
+        Removes the entries not used for max_age days, then the least
+        recently used ones until the cache holds at most max_size bytes.
+
+        Returns the removed entries
+        """
+        entries = self.entries()
+        total = sum(entry['size'] for entry in entries)
+        removed = []
+        for entry in entries:
+            too_old = max_age is not None and \
+                time.time() - entry['last_use'] > max_age * 86400
+            too_big = max_size is not None and total > max_size
+            if not (too_old or too_big):
+                continue
+            for extension in ['.npy', '.json']:
+                if os.path.isfile(self._path(entry['key'], extension)):
+                    os.remove(self._path(entry['key'], extension))
+            total -= entry['size']
+            removed.append(entry)
+        return removed
+
+
+def print_entries(entries):
+    print('{:>24} {:>10} {:>17}  {}'.format(
+        'key', 'size (MB)', 'last use', 'description'))
+    for entry in entries:
+        print('{:>24} {:>10.2f} {:>17}  {}'.format(
+            entry['key'], entry['size'] / 2**20,
+            time.strftime('%Y-%m-%d %H:%M',
+                          time.localtime(entry['last_use'])),
+            ', '.join('{}: {}'.format(k, v)
+                      for k, v in sorted(entry['description'].items()))))
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(
+        description='Lists or evicts the cached probabilities of the '
+                    'models (EXP_PATH/proba_cache)')
+    parser.add_argument('--folder', default=None,
+                        help='Folder of the cache (default: '
+                             'EXP_PATH/proba_cache)')
+    parser.add_argument('--max_age', type=float, default=None,
+                        help='Evict the entries not used for max_age days')
+    parser.add_argument('--max_size', type=float, default=None,
+                        help='Evict the least recently used entries until '
+                             'the cache holds at most max_size GB')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parseArguments()
+    cache = ProbaCache(args.folder)
+    if args.max_age is None and args.max_size is None:
+        entries = cache.entries()
+        print_entries(entries)
+        print('{} entries, {:.2f} MB'.format(
+            len(entries), sum(e['size'] for e in entries) / 2**20))
+    else:
+        removed = cache.evict(
+            args.max_age,
+            None if args.max_size is None else args.max_size * 2**30)
+        print('Evicted {} entries ({:.2f} MB)'.format(
+            len(removed), sum(e['size'] for e in removed) / 2**20))
@@ -0,0 +1,141 @@
+import csv
+import os
+import time
+import numpy as np
+
+# phases of a training epoch, in the order of the breakdown table
+PHASES = ['loader', 'run', 'metrics', 'summaries', 'save', 'validation',
+          'trace']
+
+
+def save_trace(run_metadata, folder, step):
+    """
+    Saves the trace of a step run with FULL_TRACE RunOptions: a Chrome
+    trace (timeline_<step>.json, to open in chrome://tracing) and the time
+    and memory of every op (ops_<step>.csv, slowest first).
+
+    Args:
+        run_metadata: the tf.RunMetadata filled by sess.run
+        folder: output folder (e.g. the summary_dir of the experiment)
+        step: global step of the trace
+    """
+    from tensorflow.python.client import timeline
+    os.makedirs(folder, exist_ok=True)
+    trace = timeline.Timeline(run_metadata.step_stats)
+    with open(os.path.join(folder, 'timeline_{}.json'.format(step)),
+              'w') as f:
+        f.write(trace.generate_chrome_trace_format(show_memory=True))
+    rows = []
+    for device in run_metadata.step_stats.dev_stats:
+        for node in device.node_stats:
+            # the label reads "name = Op(inputs)"
+            label = node.timeline_label
+            op = label.split(' = ')[1].split('(')[0] \
+                if ' = ' in label else node.node_name
+            rows.append([
+                device.device, node.node_name, op,
+                node.all_end_rel_micros,
+                sum(m.total_bytes for m in node.memory),
+                sum(m.peak_bytes for m in node.memory),
+                sum(o.tensor_description.allocation_description
+                    .requested_bytes for o in node.output)])
+    rows.sort(key=lambda row: -row[3])
+    with open(os.path.join(folder, 'ops_{}.csv'.format(step)), 'w',
+              newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['device', 'node', 'op', 'duration_us',
+                         'total_bytes', 'peak_bytes', 'output_bytes'])
+        writer.writerows(rows)
+    print('Trace of step {} saved to {}'.format(step, folder))
+
+
+class _Phase:
+    """ Context manager adding its wall time to a phase of the profiler """
+    __slots__ = ['totals', 'name', 'start']
+
+    def __init__(self, totals, name):
+        self.totals = totals
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.totals[self.name] += time.perf_counter() - self.start
+
+
+class _NoPhase:
+    """ Context manager of a disabled profiler """
+    __slots__ = []
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_PHASE = _NoPhase()
+
+
+class StepProfiler:
+    """
+    Wall time of the phases of the training steps (loader wait, sess.run,
+    metrics, summaries, checkpoint save, validation), summed over an epoch:
+
+        with profiler.phase('run'):
+            sess.run(...)
+
+    At the end of the epoch the breakdown is printed and summarized in
+    TensorBoard (profile/<phase>_ms, mean milliseconds per step). Disabled,
+    phase() returns a shared no-op context manager.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.totals = dict.fromkeys(PHASES, 0.0)
+        self._phases = {name: _Phase(self.totals, name) for name in PHASES}
+        self.start_epoch()
+
+    def phase(self, name):
+        """ Context manager timing a phase (one of PHASES) """
+        if not self.enabled:
+            return _NO_PHASE
+        return self._phases[name]
+
+    def start_epoch(self):
+        """ Resets the times """
+        for name in PHASES:
+            self.totals[name] = 0.0
+        self.steps = 0
+        self.epoch_start = time.perf_counter()
+
+    def step(self):
+        """ Counts one training step """
+        self.steps += 1
+
+    def end_epoch(self, logger=None, step=None):
+        """
+        Prints the breakdown of the epoch and summarizes it.
+
+        Args:
+            logger: Logger of the summaries (None to only print them)
+            step: global step of the summaries
+        """
+        if not self.enabled:
+            return
+        wall = time.perf_counter() - self.epoch_start
+        steps = max(self.steps, 1)
+        rows = [(name, self.totals[name]) for name in PHASES]
+        rows.append(('other', wall - sum(self.totals.values())))
+        print('Epoch profile: {} steps, {:.1f}s'.format(self.steps, wall))
+        print('{:>12} {:>10} {:>14} {:>7}'.format(
+            'phase', 'total (s)', 'per step (ms)', 'share'))
+        for name, total in rows:
+            print('{:>12} {:>10.2f} {:>14.2f} {:>6.1f}%'.format(
+                name, total, 1000 * total / steps,
+                100 * total / max(wall, 1e-9)))
+        if logger is not None:
+            logger.summarize(step, scope='profile', summaries_dict={
+                name + '_ms': np.float32(1000 * total / steps)
+                for name, total in rows})
@@ -18,5 +18,28 @@ def get_args():
         default=None,
         help='The name/relative path to save the combined prediction csv file'
     )
+    argparser.add_argument(
+        '-th', '--thresholds',
+        default=None,
+        help='The json file of per-class thresholds (written or read)'
+    )
+    argparser.add_argument(
+        '-r', '--resume',
+        default=False, action='store_true',
+        help='Continue an interrupted prediction from its last written row'
+    )
+    argparser.add_argument(
+        '-sp', '--single_pass',
+        default=False, action='store_true',
+        help='Predict with all the models on each test batch, read once'
+    )
+    argparser.add_argument(
+        '-pc', '--proba_cache',
+        nargs='?', const='float32', default=None,
+        choices=['float32', 'float16'],
+        help='Load the probabilities of the models from the cache '
+             '(EXP_PATH/proba_cache) or save them there, as float32 '
+             '(default) or float16'
+    )
     args = argparser.parse_args()
     return args